@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the streaming DCC query page parser against minidom on recorded
+pages, such as the .xml files in a tcgaImport.py --query-cache directory
+"""
+
+import os
+import sys
+import time
+import resource
+from glob import glob
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from xml.dom.minidom import parseString
+import tcgaImport
+
+
+def parse_dom(path):
+    with open(path) as handle:
+        data = handle.read()
+    return sum(1 for kind, value in tcgaImport.iterQueryPageDOM(parseString(data)) if kind == "class")
+
+def parse_stream(path):
+    with open(path) as handle:
+        return sum(1 for kind, value in tcgaImport.iterQueryPage(handle) if kind == "class")
+
+PARSERS = {
+    "dom" : parse_dom,
+    "stream" : parse_stream
+}
+
+def run_parser(args):
+    """Runs in a fresh worker process, so the max RSS belongs to one parser"""
+    name, paths, repeat = args
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    records = 0
+    start = time.time()
+    for i in range(repeat):
+        for path in paths:
+            records += PARSERS[name](path)
+    elapsed = time.time() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return name, records, elapsed, peak_rss - start_rss
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("pages", nargs="+", help="Recorded query pages, or directories of them")
+    parser.add_argument("-n", "--repeat", type=int, help="Times to parse each page", default=3)
+    args = parser.parse_args()
+
+    paths = []
+    for p in args.pages:
+        if os.path.isdir(p):
+            paths.extend(sorted(glob(os.path.join(p, "*.xml"))))
+        else:
+            paths.append(p)
+    if len(paths) == 0:
+        sys.stderr.write("No pages found\n")
+        sys.exit(1)
+    size = sum(os.stat(p).st_size for p in paths)
+
+    print "%d pages, %0.2fMb, %d repeats" % (len(paths), size / 1024.**2, args.repeat)
+    print "parser\trecords\tseconds\tMb/s\tpeak RSS growth (Mb)"
+    for name in sorted(PARSERS):
+        pool = Pool(1, maxtasksperchild=1)
+        try:
+            name, records, elapsed, rss = pool.apply(run_parser, [(name, paths, args.repeat)])
+        finally:
+            pool.terminate()
+            pool.join()
+        print "%s\t%d\t%0.3f\t%0.2f\t%0.2f" % (name, records, elapsed,
+            (size * args.repeat / 1024.**2) / elapsed if elapsed > 0 else 0, rss / 1024.)
@@ -1,6 +1,7 @@
 import synapseclient
 import os
 import pandas as pd
+import tcgaImport
 
 syn = synapseclient.login()
 folder = "out"
@@ -10,18 +11,19 @@ files = {x["file.name"]: x["file.id"] for x in syn.chunkedQuery("select name fro
 print 'file\tabs(maxdiff)\tmaxdiff%\tfileSize new\tfileSize old\tnew dim\told dim\tmissing_Genes_in_new\tnew_Genes_in_new'
 for f in os.listdir(folder):
     if (f.endswith(".json") or f.endswith(".bed") or 
-        f.endswith(".maf") or f.endswith('.ttl')):
+        f.endswith(".maf") or f.endswith('.ttl') or
+        f.endswith(".h5") or f.endswith(".parquet")):
         continue
     if os.path.isfile(old_folder+f):
-        df_old = pd.read_csv(old_folder+f, sep="\t", index_col=0, na_values=['null']).astype('float')
+        df_old = tcgaImport.readProduct(old_folder+f, na_values=['null']).astype('float')
         pass
     else:
         try:
-            df_old = pd.read_csv(syn.get(files[f], downloadLocation='old_out/').path, sep="\t", index_col=0, na_values=['null']).astype('float')
+            df_old = tcgaImport.readProduct(syn.get(files[f], downloadLocation='old_out/').path, na_values=['null']).astype('float')
         except KeyError:
             print f, '\tDoes not exist in local or Synapse'
             continue
-    df_new = pd.read_csv(folder + "/" + f, sep="\t", index_col=0, na_values=['null']).astype('float')
+    df_new = tcgaImport.readProduct(folder + "/" + f, na_values=['null']).astype('float')
     dim_new =df_new.shape
     dim_old = df_old.shape
 
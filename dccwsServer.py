@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+"""
+Local stand in for tcga-data.nci.nih.gov, for exercising and benchmarking
+queries, downloads and retries without the real DCC.
+
+GetXML pages are replayed from a query cache directory recorded by running
+tcgaImport.py with --query-cache against the real DCC, links inside the
+pages are rewritten to point back at this server so 'next' chains and
+xlinks keep working. Everything else is served from a mirror directory in
+deployLocation layout (tarballs and their .md5 files), with Range support.
+
+Point tcgaImport.py at it with --dcc-server http://localhost:PORT
+"""
+
+import os
+import re
+import time
+import random
+import urllib
+import logging
+import BaseHTTPServer
+import SocketServer
+from argparse import ArgumentParser
+import tcgaImport
+
+
+class DCCRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        self.handle_request(head=True)
+
+    def do_GET(self):
+        self.handle_request(head=False)
+
+    def handle_request(self, head):
+        opts = self.server.options
+        if opts.latency > 0:
+            time.sleep(random.uniform(0, 2 * opts.latency))
+        if random.random() < opts.error_rate:
+            self.send_error(503, "Injected error")
+            return
+        if self.path.startswith("/tcgadccws/"):
+            self.send_page(head)
+        else:
+            self.send_file(head)
+
+    def send_page(self, head):
+        #the query cache keys http and https urls alike, so either was recorded
+        url = "http://tcga-data.nci.nih.gov" + urllib.unquote(self.path)
+        data = self.server.pages.get(url)
+        if data is None:
+            logging.info("No recorded page for %s" % (url))
+            self.send_error(404, "No recorded page")
+            return
+        data = re.sub(r'https?://tcga-data\.nci\.nih\.gov', "http://%s:%d" % self.server.server_address[:2], data)
+        self.send_body(data, len(data), "text/xml", head)
+
+    def send_file(self, head):
+        mirror = os.path.abspath(self.server.options.mirror)
+        path = os.path.abspath(os.path.join(mirror, re.sub("^/", "", urllib.unquote(self.path.split("?")[0]))))
+        #a bare prefix test would also let /mirror-other through
+        if not path.startswith(mirror + os.sep) or not os.path.isfile(path):
+            self.send_error(404, "Not in mirror")
+            return
+        size = os.stat(path).st_size
+        start, end = 0, size - 1
+        m = re.search(r'^bytes=(\d*)-(\d*)$', self.headers.get("Range", ""))
+        if m is not None and (m.group(1) or m.group(2)):
+            if m.group(1):
+                start = int(m.group(1))
+                if m.group(2):
+                    end = min(int(m.group(2)), size - 1)
+            else:
+                start = max(0, size - int(m.group(2)))
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % (size))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        length = end - start + 1
+        handle = open(path, "rb")
+        handle.seek(start)
+        if m is not None:
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+        if not head:
+            self.send_stream(handle, length)
+        handle.close()
+
+    def send_body(self, data, length, content_type, head):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+        if not head:
+            self.send_stream(StringReader(data), length)
+
+    def send_stream(self, handle, length):
+        #a truncated body promises the full length, then drops the connection half way
+        if random.random() < self.server.options.truncate_rate:
+            length = length / 2
+            self.close_connection = 1
+        sent = 0
+        while sent < length:
+            chunk = handle.read(min(65536, length - sent))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            if self.server.options.bandwidth:
+                time.sleep(len(chunk) / (self.server.options.bandwidth * 1024.0 * 1024.0))
+
+    def log_message(self, format, *args):
+        logging.debug("%s %s" % (self.address_string(), format % args))
+
+
+class StringReader(object):
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, size):
+        out = self.data[self.pos:self.pos + size]
+        self.pos += len(out)
+        return out
+
+
+class DCCServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, options):
+        BaseHTTPServer.HTTPServer.__init__(self, address, DCCRequestHandler)
+        self.options = options
+        #ttl is ignored offline, recorded pages never expire
+        self.pages = tcgaImport.QueryCache(options.pages, offline=True)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-p", "--port", type=int, help="Port to listen on", default=8000)
+    parser.add_argument("--host", help="Address to listen on", default="localhost")
+    parser.add_argument("--pages", help="Recorded GetXML pages (a tcgaImport.py --query-cache directory)", required=True)
+    parser.add_argument("--mirror", help="Archive mirror to serve tarballs and .md5 files from", required=True)
+    parser.add_argument("--latency", type=float, help="Mean injected latency per request (seconds)", default=0)
+    parser.add_argument("--bandwidth", type=float, help="Throttle bodies to this many MB/s", default=0)
+    parser.add_argument("--error-rate", dest="error_rate", type=float, help="Fraction of requests answered with a 503", default=0)
+    parser.add_argument("--truncate-rate", dest="truncate_rate", type=float, help="Fraction of bodies cut off half way", default=0)
+    parser.add_argument("--seed", type=int, help="Random seed for fault injection", default=None)
+    parser.add_argument("-v", "--verbose", action="store_true", default=False)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    random.seed(args.seed)
+    server = DCCServer((args.host, args.port), args)
+    logging.info("Serving DCC stand in on http://%s:%d" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -4,6 +4,7 @@ from multiprocessing.dummy  import Pool
 import pandas as pd
 import synapseclient
 from synapseHelpers import query2df, thisCodeInSynapse
+import tcgaImport
 
 
 platforms = [('MDA_RPPA_Core', 'RPPA', 'mdanderson.org_PANCAN_MDA_RPPA_Core.RPPA.tsv'),
@@ -54,18 +55,18 @@ allFiles =  query2df(syn.chunkedQuery(query_str))
 for platform, dataSubType, name in platforms:
     print platform, dataSubType,
     filteredMeta = allFiles[(allFiles.platform==platform) & (allFiles.dataSubType==dataSubType) & (allFiles.acronym!='PANCAN')]
-    files = mp.map(syn.get, filteredMeta.id)
+    files = mp.map(lambda id: syn.get(id, downloadFile=False), filteredMeta.id)
     if isUptodate(name, files, args.parentId):
         print ' is up to date'
         continue
     if list(set(filteredMeta.fileType))[0] in ['seg','bed']:
-        dfs = mp.map(lambda f: pd.read_csv(f.path, sep='\t'), files)
+        dfs = mp.map(lambda f: tcgaImport.readSynapseProduct(syn, f, fileType='seg'), files)
         df = pd.concat(dfs, axis=0)
         df.to_csv(args.filepath+name, sep='\t', index=False)
         nSamples = len(set(df.Sample))
         nFeatures = 0
     else: #All other fileTypes
-        dfs = mp.map(lambda f: pd.read_csv(f.path, sep='\t', index_col=0), files)
+        dfs = mp.map(lambda f: tcgaImport.readSynapseProduct(syn, f), files)
         df = pd.concat(dfs, axis=1)
         df.to_csv(args.filepath+name, sep='\t')
         nFeatures, nSamples = df.shape
@@ -24,8 +24,10 @@ if __name__ == "__main__":
     parser.add_argument("basename", nargs="?", default=None)
     parser.add_argument("-o", "--output", help="Output File", default=None)
     parser.add_argument("--project", help="Project", default=None)
+    tcgaImport.addQueryOptions(parser)
 
     args = parser.parse_args()
+    tcgaImport.setupQueryOptions(args)
 
     if args.basename is not None:
         basename_list = [args.basename]
@@ -37,16 +37,24 @@ def loadOneSample(a):
         1) Finds the parent Folder where to store the file (or makes directories)
         2) Fetches the md5 of any existing file and compares
         3) If new or different md5 upload file.
+        4) Does the same for the binary copy the json names, if any.
     """
     logging.debug( "Loading:" + a )
     with open(a) as handle:
         meta = json.load(handle)
     dpath = re.sub(r'.json$', '', a)
+    #compressed outputs are never empty files, the json has the size before compression
+    size = meta.get('compression', {}).get('uncompressedSize', os.stat(dpath).st_size)
     #Skip the rest of the loop if data file is empty or we are not doing the current acronyms
-    if os.stat(dpath).st_size==0 or (args.acronym != meta['annotations']['acronym'] and args.acronym is not None):
+    if size==0 or (args.acronym != meta['annotations']['acronym'] and args.acronym is not None):
         return 
 
     parentId= getParentFolder(syn, args.project, meta)
+    binary = meta.get('binary')
+    if binary is not None:
+        #readSynapseProduct finds the binary copy through these
+        meta['annotations']['binaryFile'] = binary['file']
+        meta['annotations']['binaryFormat'] = binary['format']
     #Determine if we are updating an existing file and if we should update based on md5
     query = "select id from entity where parentId=='%s' and name=='%s'" % (parentId, meta['name'])
     res = list(syn.chunkedQuery(query))
@@ -54,28 +62,53 @@ def loadOneSample(a):
         tmp_ent = syn.get(res[0]['entity.id'], downloadFile=False)
         upload = (tmp_ent.md5 != meta['annotations']['md5'])
         logging.debug( "\tFound: %s and upload (MD5 %s match)" %(tmp_ent.id, 'DOESN\'T' if upload else 'does'))
+        if not upload and binary is not None and tmp_ent.annotations.get('binaryFile') != [binary['file']]:
+            logging.debug("\tBinary copy not annotated yet")
+            upload = True
     else:
         logging.debug("\tNot found:" + meta['name'])
         upload = True
     #Prepare the entity for upload
     if upload and not args.push:
         logging.info( "\tWILL UPLOAD: %s" %meta['name'])
+    if 'provenance' in meta:
+        #Fix labels for urls
+        for u in meta['provenance']['used']:
+            if 'name' not in u and 'url' in u:
+                u['name'] = u['url']
+        prov = Activity(data=meta['provenance'])
+        prov.executed('https://github.com/Sage-Bionetworks/tcgaImport')
+    else:
+        prov=None
     if upload and args.push: 
         entity = File(dpath, name=meta['name'], parentId=parentId, annotations=meta['annotations'])
-        if 'provenance' in meta:
-            #Fix labels for urls
-            for u in meta['provenance']['used']:
-                if 'name' not in u and 'url' in u:
-                    u['name'] = u['url']
-            prov = Activity(data=meta['provenance'])
-            prov.executed('https://github.com/Sage-Bionetworks/tcgaImport')
-
-        else:
-            prov=None
         logging.debug('\tUploading:%s' %entity.name)
         entity = syn.store(entity, activity=prov)
         logging.debug('\tCreated/Updated: **** %s ****' %entity.id)
+    if binary is not None:
+        loadBinaryCopy(a, meta, parentId, prov)
+
 
+def loadBinaryCopy(a, meta, parentId, prov):
+    """Uploads the binary copy the json annotation file a names, beside its product
+    and without the product's annotations, so queries for the products don't return it.
+    """
+    binary = meta['binary']
+    bpath = os.path.join(os.path.dirname(a), binary['file'])
+    query = "select id from entity where parentId=='%s' and name=='%s'" % (parentId, binary['file'])
+    res = list(syn.chunkedQuery(query))
+    if len(res) != 0:
+        tmp_ent = syn.get(res[0]['entity.id'], downloadFile=False)
+        upload = (tmp_ent.md5 != binary['md5'])
+    else:
+        upload = True
+    if upload and not args.push:
+        logging.info( "\tWILL UPLOAD: %s" %binary['file'])
+    if upload and args.push:
+        entity = File(bpath, name=binary['file'], parentId=parentId,
+                      annotations={'binaryOf' : meta['name'], 'fileType' : binary['format']})
+        entity = syn.store(entity, activity=prov)
+        logging.debug('\tCreated/Updated: **** %s ****' %entity.id)
 
 
 if __name__ == "__main__":
@@ -3,12 +3,15 @@ import synapseclient
 from synapseclient import Table
 import pandas as pd
 import synapseHelpers
+import tcgaImport
 from multiprocessing.dummy import  Pool
 
 FILEQUERY = ("select * from file where benefactorId=='%s' "
                                "and fileType!='clinicalMatrix' "
                                "and fileType!='maf' "
-                               "and fileType!='ttl'")
+                               "and fileType!='ttl' "
+                               "and fileType!='hdf5' "
+                               "and fileType!='parquet'")
 syn = synapseclient.login()
 
 
@@ -49,13 +52,13 @@ def deleteAffectedRows(updatedFiles, tableId):
 def countAndUpdateTable(input, tableId):
     i, fileMeta = input
     print 'updating table:%s' %tableId, 'with file %s(%s)' %(fileMeta['name'], fileMeta.id), fileMeta['basename']
-    ent = syn.get(fileMeta.id)
+    ent = syn.get(fileMeta.id, downloadFile=False)
     if fileMeta.fileType =='bed5':
-        data = pd.read_csv(ent.path, sep='\t')
+        data = tcgaImport.readSynapseProduct(syn, ent, columns=['Sample'], fileType='seg')
         nFeatures = 0
         samples = list(set(data.Sample.dropna()))
     else: #All other fileTypes
-        data = pd.read_csv(ent.path, sep='\t', index_col=0)
+        data = tcgaImport.readSynapseProduct(syn, ent)
         nFeatures, nSamples = data.shape
         samples = data.columns
     metadata = pd.DataFrame([fileMeta]*len(samples))
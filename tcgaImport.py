@@ -6,7 +6,9 @@ Script to scan and extract TCGA data and compile it into coherent matrices
 """
 
 from xml.dom.minidom import parseString
+import xml.etree.cElementTree as ElementTree
 import urllib
+import urllib2
 import time
 import os
 import csv
@@ -19,72 +21,657 @@ import json
 import datetime
 import hashlib
 import subprocess
+import fcntl
+import errno
+import io
+import zlib
+import cPickle as pickle
+import gzip
+import tarfile
 from glob import glob
 import shutil
 import subprocess
 import logging
 from argparse import ArgumentParser
-from urlparse import urlparse
+from distutils.spawn import find_executable
+from urlparse import urlparse, urljoin
+import httplib
+import socket
 import pandas as pd
+import numpy as np
 import string
+import sqlite3
+import threading
+from multiprocessing import Pool, cpu_count
+from multiprocessing.dummy import Pool as ThreadPool
 
 
 """
 Net query code
 """
+
+DCC_SITE = re.compile(r'^https?://tcga-data\.nci\.nih\.gov')
+#base url of a stand in for the DCC site (see dccwsServer.py), None for the real one
+dccServer = None
+
+def dccURL(url):
+    """Point a tcga-data.nci.nih.gov url at the configured DCC server"""
+    if dccServer is None:
+        return url
+    return DCC_SITE.sub(dccServer.rstrip("/"), url)
+
+class QueryCache(object):
+    """
+    On disk cache of DCC web service pages, keyed by the page URL.
+    Pages older than ttl seconds are fetched again, and the least recently
+    used pages are dropped once the cache grows past max_size bytes.
+    In offline mode pages are served from the cache regardless of age, and
+    a missing page is an error rather than a network request.
+    """
+    def __init__(self, path, ttl=None, max_size=None, offline=False):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+        self.lock = threading.Lock()
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.size = sum( size for atime, size, path in self.entries() )
+
+    def entryPath(self, url):
+        #the DCC links to itself over both http and https, a page is the same page either way
+        url = re.sub(r'^https://', "http://", url)
+        return os.path.join(self.path, hashlib.sha1(url).hexdigest() + ".xml")
+
+    def entries(self):
+        for name in os.listdir(self.path):
+            if name.endswith(".xml"):
+                path = os.path.join(self.path, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_atime, st.st_size, path
+
+    def open(self, url):
+        """Returns a handle on the cached page for url, or None"""
+        path = self.entryPath(url)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not self.offline and self.ttl is not None and time.time() - st.st_mtime > self.ttl:
+            return None
+        handle = open(path, "rb")
+        #atime tracks the last use for eviction, mtime stays the fetch time for the ttl
+        os.utime(path, (time.time(), st.st_mtime))
+        return handle
+
+    def get(self, url):
+        handle = self.open(url)
+        if handle is None:
+            return None
+        data = handle.read()
+        handle.close()
+        return data
+
+    def writer(self, url):
+        return QueryCacheWriter(self, url)
+
+    def put(self, url, data):
+        w = self.writer(url)
+        w.write(data)
+        w.commit()
+
+    def added(self, size):
+        with self.lock:
+            self.size += size
+            if self.max_size is not None and self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        entries = sorted(self.entries())
+        self.size = sum( size for atime, size, path in entries )
+        for atime, size, path in entries:
+            if self.size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            self.size -= size
+
+
+class DCCCatalog(object):
+    """
+    Local SQLite snapshot of the latest DCC Archive listing and the
+    Platform, Disease and Center tables it references. query() answers the
+    CustomQuery strings used in this script from the snapshot, and returns
+    None for anything it can't answer so the caller goes to the network.
+    Archive records point at their platform/disease/center with
+    'Platform[@id=N]' style queries, which the catalog also answers, so
+    following an xlink never leaves the database.
+    """
+    tables = {
+        'platform' : ['id', 'name', 'alias', 'displayName'],
+        'disease' : ['id', 'abbreviation', 'name', 'tissue'],
+        'center' : ['id', 'name', 'displayName'],
+        'archive' : ['id', 'baseName', 'deployLocation', 'addedDate', 'isLatest', 'archiveType', 'platform', 'disease', 'center']
+    }
+    indexes = {
+        'archive' : ['baseName', 'archiveType', 'platform', 'disease', 'center'],
+        'platform' : ['name', 'alias'],
+        'disease' : ['abbreviation']
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def sync(path):
+        """Pull the catalog from the DCC into a new database at path"""
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        os.close(fd)
+        db = sqlite3.connect(tmp)
+        for table, cols in DCCCatalog.tables.items():
+            db.execute("create table %s (%s, record text)" % (table, ", ".join(cols)))
+            for col in DCCCatalog.indexes.get(table, []):
+                db.execute("create index %s_%s on %s (%s)" % (table, col, table, col))
+
+        for table, query in [('platform', 'Platform'), ('disease', 'Disease'), ('center', 'Center')]:
+            logging.debug("Catalog sync: %s" % (query))
+            for e in CustomQuery(query):
+                if table == 'disease':
+                    e['tissue'] = None
+                    if 'tissueCollection' in e:
+                        for e2 in CustomQuery(e['tissueCollection']):
+                            e['tissue'] = e2['name']
+                DCCCatalog.insert(db, table, e)
+
+        logging.debug("Catalog sync: Archive")
+        for e in CustomQuery("Archive[@isLatest=1]"):
+            for col in ['archiveType', 'platform', 'disease', 'center']:
+                e[col] = None
+            DCCCatalog.insert(db, 'archive', e)
+
+        #resolve the archive links a whole table at a time, rather than one xlink per archive
+        for col, table, query in [
+                ('platform', 'platform', "Archive[@isLatest=1][Platform[@id=%s]]"),
+                ('disease', 'disease', "Archive[@isLatest=1][Disease[@id=%s]]"),
+                ('center', 'center', "Archive[@isLatest=1][Center[@id=%s]]")]:
+            ref_ids = [ ref_id for (ref_id,) in db.execute("select id from %s" % (table)).fetchall() ]
+            for ref_id, archive_ids in dccwsItem.engine.map(lambda ref_id: DCCCatalog.archiveIds(query, ref_id), ref_ids):
+                db.executemany("update archive set %s = ? where id = ?" % (col), [ (ref_id, a) for a in archive_ids ])
+        types = [ e['type'] for e in CustomQuery("ArchiveType") ]
+        query = "Archive[@isLatest=1][ArchiveType[@type=%s]]"
+        for archive_type, archive_ids in dccwsItem.engine.map(lambda t: DCCCatalog.archiveIds(query, t), types):
+            db.executemany("update archive set archiveType = ? where id = ?", [ (archive_type, a) for a in archive_ids ])
+        db.commit()
+        db.close()
+        os.rename(tmp, path)
+
+    @staticmethod
+    def archiveIds(query, value):
+        logging.debug("Catalog sync: %s" % (query % (value)))
+        return value, [ e['id'] for e in CustomQuery(query % (value)) ]
+
+    @staticmethod
+    def insert(db, table, record):
+        cols = DCCCatalog.tables[table]
+        db.execute("insert into %s (%s, record) values (%s)" % (table, ", ".join(cols), ", ".join(["?"] * (len(cols) + 1))),
+            [record.get(c, None) for c in cols] + [json.dumps(record)])
+
+    @staticmethod
+    def splitPredicates(text):
+        out = []
+        depth = 0
+        start = None
+        for i, c in enumerate(text):
+            if c == '[':
+                if depth == 0:
+                    start = i + 1
+                depth += 1
+            elif c == ']':
+                depth -= 1
+                if depth == 0:
+                    out.append(text[start:i])
+            elif depth == 0:
+                return None
+        if depth != 0:
+            return None
+        return out
+
+    def query(self, query):
+        m = re.search(r'^(\w+)(.*)$', query)
+        if m is None:
+            return None
+        predicates = self.splitPredicates(m.group(2))
+        if predicates is None:
+            return None
+        name = m.group(1).lower()
+        if name == 'tissuecollection':
+            m2 = re.search(r'^Disease\[@id=(.*)\]$', predicates[0]) if len(predicates) == 1 else None
+            if m2 is None:
+                return None
+            with self.lock:
+                return [ {'name' : tissue} for (tissue,) in
+                    self.db.execute("select tissue from disease where id = ? and tissue is not null", (m2.group(1),)) ]
+        if name not in self.tables:
+            return None
+
+        where = []
+        args = []
+        latest = False
+        for p in predicates:
+            m2 = re.search(r'^@?(\w+)=(.*)$', p)
+            if m2 is not None and m2.group(1) == 'isLatest' and name == 'archive':
+                #only the latest archives are in the catalog
+                if m2.group(2) != '1':
+                    return None
+                latest = True
+                continue
+            if m2 is not None:
+                if m2.group(1) not in self.tables[name] or m2.group(1) in ['platform', 'disease', 'center', 'archiveType']:
+                    return None
+                where.append("%s = ?" % (m2.group(1)))
+                args.append(m2.group(2))
+                continue
+            m2 = re.search(r'^(\w+)\[@(\w+)=(.*)\]$', p)
+            if m2 is None or name != 'archive':
+                return None
+            rel, field, value = m2.group(1).lower(), m2.group(2), m2.group(3)
+            if rel == 'archivetype' and field == 'type':
+                where.append("archiveType = ?")
+            elif rel in ['platform', 'disease', 'center'] and field in self.tables[rel]:
+                where.append("%s in (select id from %s where %s = ?)" % (rel, rel, field))
+            else:
+                return None
+            args.append(value)
+        if name == 'archive' and not latest:
+            return None
+
+        sql = "select record, %s from %s" % (", ".join(self.tables[name]), name)
+        if len(where):
+            sql += " where " + " and ".join(where)
+        sql += " order by rowid"
+        with self.lock:
+            rows = self.db.execute(sql, args).fetchall()
+        out = []
+        for row in rows:
+            record = json.loads(row[0])
+            values = dict(zip(self.tables[name], row[1:]))
+            if name == 'archive':
+                for rel in ['platform', 'disease', 'center']:
+                    if values[rel] is not None:
+                        record[rel] = "%s[@id=%s]" % (rel.capitalize(), values[rel])
+                    elif rel in record:
+                        del record[rel]
+            if name == 'disease':
+                record['tissueCollection'] = "TissueCollection[Disease[@id=%s]]" % (values['id'])
+            out.append(record)
+        return out
+
+
+class QueryCacheWriter(object):
+    """
+    Writes a page into the cache as it is read, it only replaces the
+    cache entry once commit() is called
+    """
+    def __init__(self, cache, url):
+        self.cache = cache
+        self.url = url
+        self.size = 0
+        fd, self.tmp = tempfile.mkstemp(dir=cache.path, suffix=".tmp")
+        self.handle = os.fdopen(fd, "wb")
+
+    def write(self, data):
+        self.size += len(data)
+        self.handle.write(data)
+
+    def commit(self):
+        self.handle.close()
+        path = self.cache.entryPath(self.url)
+        with self.cache.lock:
+            #a page fetched again replaces its entry, only the difference counts
+            try:
+                replaced = os.stat(path).st_size
+            except OSError:
+                replaced = 0
+            os.rename(self.tmp, path)
+        self.cache.added(self.size - replaced)
+
+    def abort(self):
+        self.handle.close()
+        os.unlink(self.tmp)
+
+
+class QueryEngine(object):
+    """
+    HTTP client for the DCC web service, shared by every query in the
+    process. Connections are kept alive and reused between pages, at most
+    max_active requests are in flight at once across all threads, and the
+    pacing adapts to the server: every failure doubles the delay between
+    request starts (up to max_delay), every success halves it again.
+    """
+    def __init__(self, max_active=8, timeout=300, min_delay=1.0, max_delay=120.0):
+        self.max_active = max_active
+        self.timeout = timeout
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay = 0.0
+        self.next_start = 0.0
+        self.slots = threading.BoundedSemaphore(max_active)
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def setMaxActive(self, max_active):
+        self.max_active = max_active
+        self.slots = threading.BoundedSemaphore(max_active)
+
+    def connect(self, scheme, host):
+        with self.lock:
+            if len(self.idle.get((scheme, host), [])):
+                return self.idle[(scheme, host)].pop()
+        return self.newConnection(scheme, host)
+
+    def newConnection(self, scheme, host):
+        if scheme == "https":
+            return httplib.HTTPSConnection(host, timeout=self.timeout)
+        return httplib.HTTPConnection(host, timeout=self.timeout)
+
+    def release(self, scheme, host, conn):
+        with self.lock:
+            self.idle.setdefault((scheme, host), []).append(conn)
+
+    def pace(self):
+        with self.lock:
+            if self.delay <= 0:
+                return
+            now = time.time()
+            start = max(now, self.next_start)
+            self.next_start = start + self.delay
+        if start > now:
+            time.sleep(start - now)
+
+    def success(self):
+        with self.lock:
+            self.delay = self.delay / 2 if self.delay / 2 >= self.min_delay else 0.0
+
+    def backoff(self):
+        """Called after a failed request, sleeps before the caller retries"""
+        with self.lock:
+            self.delay = min(self.max_delay, max(self.min_delay, self.delay * 2))
+            delay = self.delay
+        time.sleep(delay * (0.5 + random.random()))
+
+    def urlopen(self, url, redirects=5):
+        u = urlparse(url)
+        if u.scheme not in ["http", "https"]:
+            return urllib.urlopen(url)
+        self.pace()
+        #quote the same way urllib.urlopen does, DCC queries have spaces and brackets in them
+        path = urllib.quote(u.path + ("?" + u.query if u.query else ""), safe="%/:=&?~#+!$,;'@()*[]|")
+        #the slot bounds requests waiting on the server, not how long callers take to read the body
+        with self.slots:
+            conn = self.connect(u.scheme, u.netloc)
+            try:
+                conn.request("GET", path, headers={"Connection" : "keep-alive"})
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                #the server may have dropped an idle connection, try once on a fresh one,
+                #not another idle one that may have been dropped as well
+                conn.close()
+                conn = self.newConnection(u.scheme, u.netloc)
+                try:
+                    conn.request("GET", path, headers={"Connection" : "keep-alive"})
+                    response = conn.getresponse()
+                except:
+                    conn.close()
+                    raise
+        if response.status in [301, 302, 303, 307] and redirects > 0:
+            location = response.getheader("location")
+            response.read()
+            self.release(u.scheme, u.netloc, conn)
+            return self.urlopen(urljoin(url, location), redirects - 1)
+        if response.status != 200:
+            conn.close()
+            raise IOError("HTTP %s for %s" % (response.status, url))
+        return PooledResponse(self, u.scheme, u.netloc, conn, response)
+
+    def map(self, func, items):
+        """Run func over items with at most max_active running at once"""
+        if self.max_active <= 1 or len(items) <= 1:
+            return [ func(i) for i in items ]
+        pool = ThreadPool(min(self.max_active, len(items)))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+class PooledResponse(object):
+    """
+    Response handle from QueryEngine.urlopen, once it has been read to the
+    end and closed its connection goes back to the engine for reuse. Closing
+    it part way through drops the connection.
+    """
+    def __init__(self, engine, scheme, host, conn, response):
+        self.engine = engine
+        self.scheme = scheme
+        self.host = host
+        self.conn = conn
+        self.response = response
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self.response.read()
+        return self.response.read(size)
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.engine.release(self.scheme, self.host, self.conn)
+        else:
+            self.conn.close()
+        self.conn = None
+
+
+class TeeReader(object):
+    """File like wrapper that copies everything read from handle into out"""
+    def __init__(self, handle, out):
+        self.handle = handle
+        self.out = out
+
+    def read(self, size=-1):
+        data = self.handle.read(size)
+        self.out.write(data)
+        return data
+
+    def close(self):
+        self.handle.close()
+
+
 class dccwsItem(object):
     baseURL = "http://tcga-data.nci.nih.gov/tcgadccws/GetXML?query="
+    cache = None
+    catalog = None
+    engine = QueryEngine()
+    #'stream' parses pages incrementally, 'dom' builds a minidom tree per page
+    parser = "stream"
 
-    def __init__(self):
+    def __init__(self, parser=None):
         self.url = None
+        self.query = None
+        self.parser = parser or dccwsItem.parser
             
-    def __iter__(self):
-        next = self.url        
-        while next != None:
-            retry_count = 3
-            while retry_count > 0:
+    def getPage(self, url):
+        if dccwsItem.cache is not None:
+            data = dccwsItem.cache.get(url)
+            if data is not None:
+                return parseString(data)
+            if dccwsItem.cache.offline:
+                raise Exception("Offline and not in query cache: %s" % (url))
+        retry_count = 3
+        while retry_count > 0:
+            try:
+                data = None
+                handle = dccwsItem.engine.urlopen(url)
                 try:
-                    data = None
-                    handle = urllib.urlopen(next)
                     data = handle.read()
+                finally:
                     handle.close()
-                    dom = parseString(data)
-                    retry_count = 0
-                except Exception, e:
-                    retry_count -= 1
-                    if retry_count <= 0:
-                        sys.stderr.write("URL %s : Message Error: %s\n" % (next, data ) )
-                        raise e
-                    time.sleep(random.randint(10, 35))
-            # there might not be any archives for a dataset
-            if len(dom.getElementsByTagName('queryResponse')) > 0:
-                response = dom.getElementsByTagName('queryResponse').pop()
-                classList = response.getElementsByTagName('class')
-                for cls in classList:
-                    className = cls.getAttribute("recordNumber")
-                    outData = {}
-                    #aObj = Archive()
-                    for node in cls.childNodes:
-                        nodeName = node.getAttribute("name")
-                        if node.hasAttribute("xlink:href"):
-                            outData[ nodeName ] = node.getAttribute("xlink:href")            
-                        else:
-                            outData[ nodeName ] = getText( node.childNodes )
+                dom = parseString(data)
+                dccwsItem.engine.success()
+                retry_count = 0
+            except Exception, e:
+                retry_count -= 1
+                if retry_count <= 0:
+                    sys.stderr.write("URL %s : Message Error: %s\n" % (url, data ) )
+                    raise e
+                dccwsItem.engine.backoff()
+        if dccwsItem.cache is not None:
+            dccwsItem.cache.put(url, data)
+        return dom
+
+    def domPage(self, url):
+        for out in iterQueryPageDOM(self.getPage(url)):
+            yield out
+
+    def streamPage(self, url):
+        """
+        Parse the page while it is read from the network or the cache, so
+        records are yielded as soon as they close and the page is never
+        held in memory. A page that fails before any record was yielded is
+        fetched again, after that the error is raised.
+        """
+        if dccwsItem.cache is not None:
+            handle = dccwsItem.cache.open(url)
+            if handle is not None:
+                for out in iterQueryPage(handle):
+                    yield out
+                handle.close()
+                return
+            if dccwsItem.cache.offline:
+                raise Exception("Offline and not in query cache: %s" % (url))
+        retry_count = 3
+        while retry_count > 0:
+            count = 0
+            handle = None
+            writer = None
+            try:
+                handle = dccwsItem.engine.urlopen(url)
+                if dccwsItem.cache is not None:
+                    writer = dccwsItem.cache.writer(url)
+                    handle = TeeReader(handle, writer)
+                for out in iterQueryPage(handle):
+                    count += 1
+                    yield out
+                handle.close()
+                if writer is not None:
+                    writer.commit()
+                dccwsItem.engine.success()
+                retry_count = 0
+            except GeneratorExit:
+                #the caller stopped reading part way through the page
+                handle.close()
+                if writer is not None:
+                    writer.abort()
+                raise
+            except Exception, e:
+                if handle is not None:
+                    handle.close()
+                if writer is not None:
+                    writer.abort()
+                retry_count -= 1
+                if retry_count <= 0 or count > 0:
+                    sys.stderr.write("URL %s : Message Error: %s\n" % (url, e) )
+                    raise e
+                dccwsItem.engine.backoff()
+
+    def __iter__(self):
+        if dccwsItem.catalog is not None and self.query is not None:
+            records = dccwsItem.catalog.query(self.query)
+            if records is not None:
+                for outData in records:
                     yield outData
-            if len( dom.getElementsByTagName('next') ) > 0:
-                nextElm = dom.getElementsByTagName('next').pop()
-                next = nextElm.getAttribute( 'xlink:href' )
+                return
+        next = self.url        
+        while next != None:
+            if self.parser == "dom":
+                page = self.domPage(next)
             else:
-                next = None
+                page = self.streamPage(next)
+            next = None
+            for kind, value in page:
+                if kind == "next":
+                    next = value
+                else:
+                    yield value
+
+
+XLINK_HREF = "{http://www.w3.org/1999/xlink}href"
+
+def iterQueryPage(handle):
+    """
+    Incrementally parse a DCC query page from handle, yields ('class', record)
+    as each record element closes, and ('next', url) for the next page link.
+    Finished records are dropped from the tree so memory stays flat.
+    """
+    response = None
+    for event, elem in ElementTree.iterparse(handle, events=("start", "end")):
+        tag = elem.tag.split("}")[-1]
+        if event == "start":
+            if tag == "queryResponse":
+                response = elem
+            continue
+        if tag == "class":
+            outData = {}
+            for node in elem:
+                nodeName = node.get("name", "")
+                if XLINK_HREF in node.attrib:
+                    outData[ nodeName ] = node.get(XLINK_HREF)
+                else:
+                    outData[ nodeName ] = "".join( [node.text or ""] + [c.tail or "" for c in node] )
+            yield "class", outData
+            if response is not None:
+                response.clear()
+        elif tag == "next":
+            yield "next", elem.get(XLINK_HREF)
+
+def iterQueryPageDOM(dom):
+    """Walk a minidom DCC query page, yields the same values as iterQueryPage"""
+    # there might not be any archives for a dataset
+    if len(dom.getElementsByTagName('queryResponse')) > 0:
+        response = dom.getElementsByTagName('queryResponse').pop()
+        classList = response.getElementsByTagName('class')
+        for cls in classList:
+            className = cls.getAttribute("recordNumber")
+            outData = {}
+            #aObj = Archive()
+            for node in cls.childNodes:
+                nodeName = node.getAttribute("name")
+                if node.hasAttribute("xlink:href"):
+                    outData[ nodeName ] = node.getAttribute("xlink:href")            
+                else:
+                    outData[ nodeName ] = getText( node.childNodes )
+            yield "class", outData
+    if len( dom.getElementsByTagName('next') ) > 0:
+        nextElm = dom.getElementsByTagName('next').pop()
+        yield "next", nextElm.getAttribute( 'xlink:href' )
 
 
 class CustomQuery(dccwsItem):
-    def __init__(self, query):
-        super(CustomQuery, self).__init__()
+    def __init__(self, query, parser=None):
+        super(CustomQuery, self).__init__(parser)
+        self.query = query
         if query.startswith("http://"):
-            self.url = query
+            self.url = dccURL(query)
         else:
-            self.url = dccwsItem.baseURL + query
+            self.url = dccURL(dccwsItem.baseURL + query)
 
    
     
@@ -94,6 +681,395 @@ Build Configuration
 
 """
 
+class FileLock(object):
+    """
+    Exclusive lock shared between jobs on the cluster, held on path with
+    fcntl record locks (which also work over NFS). Those are per process,
+    so a per path thread lock covers the download threads within one job.
+    The lock file is removed on release, while the lock is still held, so
+    a job that locked the old file once it was unlinked tries again.
+    """
+    threadLocks = {}
+    threadLocksLock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self.handle = None
+
+    def threadLock(self):
+        """Take the thread lock for path, counted so the last thread to release it drops the entry"""
+        with FileLock.threadLocksLock:
+            entry = FileLock.threadLocks.setdefault(self.path, [threading.Lock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+
+    def threadUnlock(self):
+        with FileLock.threadLocksLock:
+            entry = FileLock.threadLocks[self.path]
+            entry[0].release()
+            entry[1] -= 1
+            if entry[1] == 0:
+                del FileLock.threadLocks[self.path]
+
+    def __enter__(self):
+        self.threadLock()
+        try:
+            while True:
+                self.handle = open(self.path, "a")
+                try:
+                    fcntl.lockf(self.handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    logging.info("waiting for lock %s" % (self.path))
+                    fcntl.lockf(self.handle, fcntl.LOCK_EX)
+                try:
+                    st = os.stat(self.path)
+                except OSError:
+                    st = None
+                held = os.fstat(self.handle.fileno())
+                if st is not None and (st.st_dev, st.st_ino) == (held.st_dev, held.st_ino):
+                    break
+                #the holder we waited on removed this file, lock the one at path now
+                self.handle.close()
+        except:
+            self.threadUnlock()
+            raise
+        return self
+
+    def __exit__(self, type, value, tb):
+        os.unlink(self.path)
+        fcntl.lockf(self.handle, fcntl.LOCK_UN)
+        self.handle.close()
+        self.threadUnlock()
+
+
+def linkFile(src, dst):
+    """Atomically make dst a hard link to src, or a symlink if they are on different filesystems"""
+    tmp = "%s.%d.link" % (dst, os.getpid())
+    if os.path.lexists(tmp):
+        os.unlink(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError, e:
+        if e.errno != errno.EXDEV:
+            raise
+        os.symlink(os.path.abspath(src), tmp)
+    os.rename(tmp, dst)
+
+
+class ContentStore(object):
+    """
+    Content addressed store for a mirror, kept in <mirror>/.cas. Objects
+    are named by md5, and the deployLocation paths in the mirror are links
+    to them, so an archive that is identical across revisions is only
+    downloaded and stored once.
+    """
+    def __init__(self, mirror, md5index):
+        self.path = os.path.join(mirror, ".cas")
+        self.md5index = md5index
+
+    def objectPath(self, md5):
+        return os.path.join(self.path, md5[:2], md5)
+
+    def has(self, md5):
+        path = self.objectPath(md5)
+        #an object that went bad on disk is as good as missing
+        return os.path.exists(path) and self.md5index.digest(path) == md5
+
+    def linkOut(self, md5, dst):
+        linkFile(self.objectPath(md5), dst)
+
+    def add(self, path, md5):
+        """Store the file at path under md5, if the store already had it path becomes a link to that copy"""
+        obj = self.objectPath(md5)
+        if self.has(md5):
+            if not os.path.samefile(obj, path):
+                linkFile(obj, path)
+                self.md5index.record(path, md5)
+            return False
+        if not os.path.exists(os.path.dirname(obj)):
+            try:
+                os.makedirs(os.path.dirname(obj))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(obj)):
+                    raise
+        linkFile(path, obj)
+        return True
+
+
+class ExtractCache(object):
+    """
+    Archives extracted once and kept between builds, under path and keyed by
+    the md5 of the tarball, so a rebuild reuses the trees of the archives
+    that haven't changed. Entries are built in path/tmp and renamed into
+    place. A job holds a shared lock on each entry it is reading until it
+    calls release, eviction only takes entries it can lock exclusively, so
+    the trees in use by other jobs are left alone. The least recently used
+    entries go once the cache is over max_size bytes.
+    With dedupe, identical member files across entries are hard links to
+    one copy in path/.objects. Linking to the objects and sweeping the ones
+    no entry uses any more both happen under path/objects.lock.
+    """
+    def __init__(self, path, max_size=None, dedupe=False):
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+        self.dedupe = dedupe
+        self.lock = threading.Lock()
+        self.md5Locks = {}
+        self.leases = {}
+        for dir in (self.path, os.path.join(self.path, "tmp")):
+            if not os.path.exists(dir):
+                try:
+                    os.makedirs(dir)
+                except OSError:
+                    if not os.path.isdir(dir):
+                        raise
+
+    def entryPath(self, md5):
+        return os.path.join(self.path, md5[:2], md5)
+
+    def contains(self, path):
+        """Is path inside the cache, a hard link to it would stop eviction from freeing the space"""
+        return os.path.realpath(path).startswith(os.path.realpath(self.path) + os.sep)
+
+    def entries(self):
+        for sizePath in glob(os.path.join(self.path, "??", "*.size")):
+            try:
+                st = os.stat(sizePath)
+                handle = open(sizePath)
+                size = int(handle.read())
+                handle.close()
+            except (OSError, IOError, ValueError):
+                continue
+            yield st.st_mtime, size, sizePath[:-len(".size")]
+
+    def acquire(self, md5, extract):
+        """
+        Path of the extracted tree for the tarball with md5, calling
+        extract(dir) to fill it in if it isn't cached. The tree is leased
+        to this job until release is called.
+        """
+        with self.lock:
+            md5Lock = self.md5Locks.setdefault(md5, threading.Lock())
+        with md5Lock:
+            entry = self.entryPath(md5)
+            if md5 in self.leases:
+                return entry
+            if not os.path.exists(os.path.dirname(entry)):
+                try:
+                    os.makedirs(os.path.dirname(entry))
+                except OSError:
+                    if not os.path.isdir(os.path.dirname(entry)):
+                        raise
+            handle = open(entry + ".lock", "a+")
+            fcntl.lockf(handle, fcntl.LOCK_SH)
+            try:
+                if not os.path.exists(entry + ".size"):
+                    #build it under the exclusive lock, then step down to shared without letting go
+                    fcntl.lockf(handle, fcntl.LOCK_UN)
+                    fcntl.lockf(handle, fcntl.LOCK_EX)
+                    if not os.path.exists(entry + ".size"):
+                        self.build(entry, extract)
+                    fcntl.lockf(handle, fcntl.LOCK_SH)
+                else:
+                    print "Extract cache hit", md5
+                os.utime(entry + ".size", None)
+            except:
+                handle.close()
+                raise
+            with self.lock:
+                self.leases[md5] = handle
+        self.evict()
+        return entry
+
+    def build(self, entry, extract):
+        tmp = tempfile.mkdtemp(dir=os.path.join(self.path, "tmp"))
+        try:
+            extract(tmp)
+            if self.dedupe:
+                self.dedupeTree(tmp)
+            size = treeSize(tmp)
+            if os.path.exists(entry):
+                #left behind by a job that died before writing the size
+                shutil.rmtree(entry)
+            os.rename(tmp, entry)
+        except:
+            shutil.rmtree(tmp, True)
+            raise
+        handle = open(entry + ".size.tmp", "w")
+        handle.write("%d\n" % (size))
+        handle.close()
+        os.rename(entry + ".size.tmp", entry + ".size")
+
+    def objectPath(self, md5):
+        return os.path.join(self.path, ".objects", md5[:2], md5)
+
+    def objectLock(self):
+        return FileLock(os.path.join(self.path, "objects.lock"))
+
+    def dedupeTree(self, root):
+        digests = []
+        for dir, dirs, files in os.walk(root):
+            for name in files:
+                path = os.path.join(dir, name)
+                if not os.path.islink(path):
+                    digests.append( (path, fileDigest(path)) )
+        #evict must not sweep an object between finding it here and linking to it
+        with self.objectLock():
+            for path, md5 in digests:
+                obj = self.objectPath(md5)
+                if os.path.exists(obj):
+                    linkFile(obj, path)
+                    continue
+                if not os.path.exists(os.path.dirname(obj)):
+                    os.makedirs(os.path.dirname(obj))
+                os.link(path, obj)
+
+    def release(self):
+        """Let go of every tree this job has acquired"""
+        with self.lock:
+            for md5, handle in self.leases.items():
+                fcntl.lockf(handle, fcntl.LOCK_UN)
+                handle.close()
+            self.leases = {}
+
+    def evict(self):
+        if self.max_size is None:
+            return
+        entries = sorted(self.entries())
+        total = sum( size for mtime, size, entry in entries )
+        for mtime, size, entry in entries:
+            if total <= self.max_size:
+                break
+            md5 = os.path.basename(entry)
+            #held until the entry is gone, so no thread of this job can start using it in between
+            with self.lock:
+                #fcntl locks don't stop this process, and closing any handle on a lock file drops all of them
+                if md5 in self.md5Locks:
+                    continue
+                handle = open(entry + ".lock", "a+")
+                try:
+                    fcntl.lockf(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    #in use by another job
+                    handle.close()
+                    continue
+                try:
+                    os.unlink(entry + ".size")
+                    shutil.rmtree(entry, True)
+                finally:
+                    fcntl.lockf(handle, fcntl.LOCK_UN)
+                    handle.close()
+            total -= size
+        if self.dedupe:
+            #objects no entry links to any more
+            with self.objectLock():
+                for obj in glob(os.path.join(self.path, ".objects", "??", "*")):
+                    try:
+                        if os.stat(obj).st_nlink == 1:
+                            os.unlink(obj)
+                    except OSError:
+                        pass
+
+
+class MirrorDownloader(object):
+    """
+    Fetches archives into the mirror. Each file is written to a .part file
+    beside its destination, and a cut off transfer is resumed with an HTTP
+    Range request. The file is only renamed into place once its size
+    matches what the server announced and, when the DCC publishes an .md5
+    for it, the digest matches.
+    """
+    def __init__(self, retries=5, chunk_size=1024*1024, store=None):
+        self.retries = retries
+        self.chunk_size = chunk_size
+        self.store = store
+        #md5 of every archive this downloader verified, by mirror path
+        self.digests = {}
+
+    def fetch(self, src, dst):
+        attempt = 0
+        while True:
+            try:
+                md5 = self.fetchMD5(src, dst)
+                if md5 is not None and self.store is not None and self.store.has(md5):
+                    #same bytes as an archive we already have, most likely another revision
+                    print "link %s to stored %s" % (dst, md5)
+                    self.store.linkOut(md5, dst)
+                    os.rename(dst + ".md5.part", dst + ".md5")
+                    self.digests[dst] = md5
+                    return dst
+                digest = self.fetchPart(src, dst + ".part")
+                if md5 is not None and digest != md5:
+                    #a bad file can't be resumed, start over
+                    os.unlink(dst + ".part")
+                    raise IOError("MD5 mismatch for %s" % (src))
+                if md5 is not None:
+                    os.rename(dst + ".md5.part", dst + ".md5")
+                os.rename(dst + ".part", dst)
+                self.digests[dst] = digest
+                if self.store is not None:
+                    self.store.add(dst, digest)
+                return dst
+            except (IOError, httplib.HTTPException, socket.error), e:
+                attempt += 1
+                if attempt >= self.retries:
+                    raise
+                logging.warning("Download %s failed (%s), retrying" % (src, e))
+                time.sleep(min(60, 2 ** attempt) * (0.5 + random.random()))
+
+    def fetchMD5(self, src, dst):
+        """Fetch the DCC .md5 for src into dst.md5.part, returns the digest or None if there isn't one"""
+        try:
+            handle = urllib2.urlopen(src + ".md5")
+        except urllib2.HTTPError, e:
+            if e.code == 404:
+                return None
+            raise
+        data = handle.read()
+        handle.close()
+        md5 = data.split(" ")[0].strip()
+        if not re.search(r'^[0-9a-f]{32}$', md5):
+            raise IOError("Bad md5 file for %s" % (src))
+        out = open(dst + ".md5.part", "w")
+        out.write(data)
+        out.close()
+        return md5
+
+    def fetchPart(self, src, part):
+        """Download src into part, returns the md5 of part, computed as the bytes arrive"""
+        md5 = hashlib.md5()
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        request = urllib2.Request(src)
+        if offset > 0:
+            request.add_header("Range", "bytes=%d-" % (offset))
+        try:
+            handle = urllib2.urlopen(request)
+        except urllib2.HTTPError, e:
+            if e.code == 416:
+                #the part file is already complete
+                return fileDigest(part)
+            raise
+        if handle.getcode() == 206:
+            total = int(handle.info().getheader("Content-Range").split("/")[-1])
+            #only the bytes already on disk get read back
+            fileDigest(part, md5)
+            out = open(part, "ab")
+            print "resume %s at %d of %d bytes" % (src, offset, total)
+        else:
+            length = handle.info().getheader("Content-Length")
+            total = int(length) if length is not None else None
+            out = open(part, "wb")
+            print "download %s to %s" % (src, part)
+        for chunk in iter(lambda: handle.read(self.chunk_size), ''):
+            md5.update(chunk)
+            out.write(chunk)
+        out.close()
+        handle.close()
+        if total is not None and os.path.getsize(part) != total:
+            raise IOError("Short read on %s: %d of %d bytes" % (src, os.path.getsize(part), total))
+        return md5.hexdigest()
+
+
 class BuildConf:
     def __init__(self, platform, name, version, meta, tarlist):
         self.platform = platform
@@ -117,6 +1093,39 @@ class BuildConf:
         self.errorpath = opts.errorpath
         self.clinical_type = opts.clinical_type
         self.rmControl = opts.rmControl
+        self.download_jobs = opts.download_jobs
+        self.md5index = ChecksumIndex(self.mirror) if self.mirror is not None else None
+        self.downloader = MirrorDownloader()
+        if opts.cas and self.mirror is not None:
+            self.downloader.store = ContentStore(self.mirror, self.md5index)
+        self.checksum = opts.checksum
+        self.checksum_delete = opts.checksum_delete
+        self.single_pass = opts.single_pass
+        self.stream = opts.stream
+        self.jobs = opts.jobs
+        self.matrix_store = opts.matrix_store
+        self.incremental = opts.incremental
+        self.binary = opts.binary
+        self.compress = opts.compress
+        self.bgzip = None
+        if self.compress == "bgzip":
+            self.bgzip = find_executable("bgzip")
+            if self.bgzip is None:
+                print "bgzip not found, compressing with gzip"
+                self.compress = "gzip"
+        if self.binary is not None and not binaryAvailable(self.binary):
+            print "%s not installed, writing %s output as TSV only" % (BINARY_FORMATS[self.binary][1], self.binary)
+            self.binary = None
+        self.tar_index = opts.tar_index
+        self.extract_jobs = opts.extract_jobs
+        self.decoder = None
+        self.extract_cache = None
+        if opts.extract_cache is not None:
+            self.extract_cache = ExtractCache(opts.extract_cache, opts.extract_cache_size * 1024 * 1024, dedupe=opts.cas)
+        if opts.pigz:
+            self.decoder = findDecoder()
+            if self.decoder is None:
+                print "pigz not found, decompressing with gzip"
 
         self.clinical_type_map = {}
         for t, path, meta in opts.out_clinical:
@@ -134,21 +1143,85 @@ class BuildConf:
             print "Define mirror location"
             sys.exit(1)
 
-        src = url # "https://tcga-data.nci.nih.gov/" + url
+        src = dccURL(url) # "https://tcga-data.nci.nih.gov/" + url
         path = urlparse(url).path
         dst = os.path.join(self.mirror, re.sub("^/", "", path))
         dir = os.path.dirname(dst)
         if not os.path.exists(dir):
             print "mkdir", dir
-            os.makedirs(dir)
+            try:
+                os.makedirs(dir)
+            except OSError:
+                #another download thread made it first
+                if not os.path.isdir(dir):
+                    raise
         if not os.path.exists( dst ):
             if self.download:    
-                print "download %s to %s" % (src, dst)
-                urllib.urlretrieve(src, dst)
+                #the first job to want an archive downloads it, the rest wait and reuse it
+                with FileLock(dst + ".lock"):
+                    if not os.path.exists( dst ):
+                        self.downloader.fetch(src, dst)
+                        self.md5index.record(dst, self.downloader.digests[dst])
             else:
                 raise Exception("Missing source file: %s" % url)
         return dst
 
+    def checkDigest(self, path, digest):
+        """
+        Compare the md5 of a mirrored archive against its .md5 file, with
+        --checksum-delete a corrupt archive is removed from the mirror
+        """
+        self.md5index.record(path, digest)
+        if self.downloader.digests.get(path, None) == digest:
+            #verified while it downloaded
+            return True
+        omd5 = readMD5File(path + ".md5")
+        if omd5 is None:
+            print "MD5_NOT_FOUND", path
+            return True
+        if omd5 != digest:
+            print "CORRUPT:", path
+            if self.checksum_delete:
+                with FileLock(path + ".lock"):
+                    os.unlink(path)
+                    os.unlink(path + ".md5")
+            return False
+        print "OK:", path
+        return True
+
+    def refetchArchive(self, url, path):
+        """Mirror path of a new copy of url, once checkDigest has removed the corrupt one at path"""
+        if not self.download:
+            raise Exception("Corrupt archive %s was removed from the mirror, run again with --download to fetch a new copy" % (path))
+        return self.getURLPath(url)
+
+    def fetchArchive(self, url):
+        """
+        Mirror path for url. With --checksum the mirrored copy is checked
+        first, so with --checksum-delete --download a corrupt archive is
+        fetched again here
+        """
+        #with --single-pass the checksum is taken while the archives are extracted
+        if (self.checksum or self.checksum_delete) and not self.single_pass:
+            dst = os.path.join(self.mirror, re.sub("^/", "", urlparse(url).path))
+            if not os.path.exists( dst ):
+                print "NOT_FOUND:", dst
+            else:
+                self.checkDigest(dst, self.md5index.digest(dst))
+        return self.getURLPath(url)
+
+    def fetchArchives(self, urls):
+        """Mirror paths for urls, the archives are checked and downloaded several at a time"""
+        checking = (self.checksum or self.checksum_delete) and not self.single_pass
+        if (self.download or checking) and self.download_jobs > 1 and len(urls) > 1:
+            pool = ThreadPool(min(self.download_jobs, len(urls)))
+            try:
+                return pool.map(self.fetchArchive, urls)
+            finally:
+                pool.terminate()
+                pool.join()
+        return [ self.fetchArchive(url) for url in urls ]
+
 
 
 
@@ -190,14 +1263,49 @@ class BuildConf:
         return os.path.join(self.outdir, self.name) + name + ".error"
 
 
+class XlinkResolver(object):
+    """
+    Resolves xlink hrefs (or any CustomQuery string) to their list of
+    records, remembering the answer for the life of the process. Hrefs that
+    haven't been seen before are fetched concurrently through the query engine.
+    """
+    def __init__(self):
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def fetch(self, href):
+        return href, list(CustomQuery(href))
+
+    def resolve(self, hrefs):
+        with self.lock:
+            todo = list(set( h for h in hrefs if h not in self.results ))
+        results = dccwsItem.engine.map(self.fetch, todo)
+        with self.lock:
+            self.results.update(results)
+            return dict( (h, self.results[h]) for h in hrefs )
+
+xlinkResolver = XlinkResolver()
+
+
 def getBaseBuildConf(basename, platform, mirror):
     dates = []
     logging.debug("TCGA Query for: %s" % (basename))
-    q = tcgaConfig[platform].getArchiveQuery(basename)
+    archives = list(tcgaConfig[platform].getArchiveQuery(basename))
+    logging.debug("TCGA Query for mage-tab: %s" % (basename))
+    mageArchives = list(CustomQuery("Archive[@baseName=%s][@isLatest=1][ArchiveType[@type=mage-tab]]" % (basename)))
+
+    #resolve all the platform/disease/center links in one concurrent round
+    hrefs = [ e['platform'] for e in mageArchives ]
+    if len(archives):
+        hrefs += [ archives[0]['platform'], archives[0]['disease'], archives[0]['center'] ]
+    links = xlinkResolver.resolve(hrefs)
+    if len(archives):
+        links.update( xlinkResolver.resolve( [ e2['tissueCollection'] for e2 in links[archives[0]['disease']] ] ) )
+
     urls = {}
     meta = None
     platform = None
-    for e in q:
+    for e in archives:
         dates.append( datetime.datetime.strptime( e['addedDate'], "%m-%d-%Y" ) )
         if meta is None:
             meta = {
@@ -205,16 +1313,16 @@ def getBaseBuildConf(basename, platform, mirror):
                 'annotations' : {'species' : 'Homo sapiens', 'disease' : 'cancer'},
                 'provenance' : { 'name' : 'tcgaImport', 'used' : [] }
             }            
-            for e2 in CustomQuery(e['platform']):
+            for e2 in links[e['platform']]:
                 platform = e2['name']
                 meta['annotations']['platform'] = e2['name']
                 meta['annotations']['platformTitle'] = e2['displayName']
-            for e2 in CustomQuery(e['disease']):
+            for e2 in links[e['disease']]:
                 meta['annotations']['acronym'] = e2['abbreviation']
                 meta['annotations']['diseaseTitle'] = e2['name']
-                for e3 in CustomQuery(e2['tissueCollection']):
+                for e3 in links[e2['tissueCollection']]:
                     meta['annotations']['tissue'] = e3['name']
-            for e2 in CustomQuery(e['center']):
+            for e2 in links[e['center']]:
                 meta['annotations']['centerTitle'] = e2['displayName']
                 meta['annotations']['center'] = e2['name']
                 meta['annotations']['basename'] = basename
@@ -226,13 +1334,10 @@ def getBaseBuildConf(basename, platform, mirror):
         )
         urls[ mirror + e['deployLocation'] ] = platform
 
-    logging.debug("TCGA Query for mage-tab: %s" % (basename))
-    q = CustomQuery("Archive[@baseName=%s][@isLatest=1][ArchiveType[@type=mage-tab]]" % (basename))
-    for e in q:
+    for e in mageArchives:
         dates.append( datetime.datetime.strptime( e['addedDate'], "%m-%d-%Y" ) )
-        q2 = CustomQuery(e['platform'])
         platform = None
-        for e2 in q2:
+        for e2 in links[e['platform']]:
             logging.debug("%s" % (e2))
             platform = e2['name']
         meta['provenance']['used'].append( 
@@ -266,10 +1371,293 @@ class TableReader:
             handle.close()
 
 
+class TSVWriter(object):
+    """
+    Writes tab separated output byte for byte as DataFrame.to_csv(sep="\t",
+    float_format=...) does, but formats whole blocks of rows at once. When every
+    column is numeric and no row label needs quoting, a block is formatted with
+    one '%' per row and the nan cells blanked afterwards, otherwise the cells
+    are converted the way pandas does and go through csv.writer. With jobs > 1
+    blocks are formatted in worker processes and written here in order.
+    labels are formatted row label cells, or None for no index, columns are
+    1d arrays and formats the format string for each column, None for
+    object and boolean columns.
+    """
+    def __init__(self, header, labels, columns, formats, block_size=8192):
+        self.header = header
+        self.labels = labels
+        self.columns = columns
+        self.formats = formats
+        self.block_size = block_size
+        self.nrows = len(columns[0]) if len(columns) else len(labels or [])
+        self.fast = len(columns) > 0 and None not in formats and len(set(column.dtype for column in columns)) == 1
+        if self.fast and labels is not None:
+            self.fast = all( isinstance(label, str) and TSV_QUOTE.search(label) is None for label in labels )
+        if self.fast:
+            self.rowFormat = "\t".join(formats)
+            if labels is not None:
+                self.rowFormat = "%s\t" + self.rowFormat
+            self.hasNan = columns[0].dtype.kind == "f"
+
+    @staticmethod
+    def fromFrame(df, index=True, float_format="%0.6g", block_size=8192):
+        """A writer for df.to_csv(path, sep="\t", index=index, float_format=float_format), None if df needs to_csv"""
+        if float_format is None or isinstance(df.index, pd.MultiIndex) or isinstance(df.columns, pd.MultiIndex):
+            return None
+        if any( dtype.kind not in "fiubO" for dtype in df.dtypes ) or (index and df.index.dtype.kind not in "fiubO"):
+            return None
+        header = tsvCells(df.columns.values, float_format)
+        labels = None
+        if index:
+            header = [ "" if df.index.name is None else df.index.name ] + header
+            labels = tsvCells(df.index.values, float_format)
+        columns = [ df.iloc[:, j].values for j in range(df.shape[1]) ]
+        formats = []
+        for column in columns:
+            if column.dtype.kind == "f":
+                formats.append(float_format)
+            elif column.dtype.kind in "iu":
+                formats.append("%d")
+            else:
+                formats.append(None)
+        return TSVWriter(header, labels, columns, formats, block_size)
+
+    def block(self, start):
+        end = min(start + self.block_size, self.nrows)
+        if self.fast:
+            values = np.empty((end - start, len(self.columns)), dtype=self.columns[0].dtype)
+            for j, column in enumerate(self.columns):
+                values[:, j] = column[start:end]
+            rows = values.tolist()
+            if self.labels is not None:
+                text = "\n".join( self.rowFormat % tuple([label] + row) for label, row in zip(self.labels[start:end], rows) )
+            else:
+                text = "\n".join( self.rowFormat % tuple(row) for row in rows )
+            text += "\n"
+            if self.hasNan and np.isnan(values).any():
+                if self.labels is not None:
+                    #a nan cell is always between two tabs or a tab and the line end, runs of them
+                    #lose every other leading tab to the first replace and are caught by the second
+                    text = text.replace("\tnan\t", "\t\t").replace("\tnan\t", "\t\t").replace("\tnan\n", "\t\n")
+                elif len(self.columns) == 1:
+                    #csv.writer quotes a row that is just one empty field
+                    text = TSV_NAN.sub('""', text)
+                else:
+                    text = TSV_NAN.sub("", text)
+            return text
+        cells = []
+        for column, format in zip(self.columns, self.formats):
+            if format is not None and column.dtype.kind == "f":
+                cells.append([ "" if v != v else format % v for v in column[start:end].tolist() ])
+            else:
+                cells.append(tsvCells(column[start:end], None))
+        if self.labels is not None:
+            cells = [ self.labels[start:end] ] + cells
+        out = io.BytesIO()
+        csv.writer(out, delimiter="\t", lineterminator="\n").writerows(zip(*cells))
+        return out.getvalue()
+
+    def write(self, handle, jobs=1):
+        global tsvWriter
+        csv.writer(handle, delimiter="\t", lineterminator="\n").writerow(self.header)
+        starts = range(0, self.nrows, self.block_size)
+        if jobs > 1 and len(starts) > 1:
+            #the workers are forked with this writer, only block offsets go out
+            tsvWriter = self
+            pool = Pool(min(jobs, len(starts)))
+            try:
+                for text in pool.imap(tsvWorker, starts):
+                    handle.write(text)
+            finally:
+                pool.terminate()
+                pool.join()
+                tsvWriter = None
+        else:
+            for start in starts:
+                handle.write(self.block(start))
+
+
+class MatrixStore(object):
+    """
+    Out of core column store for matrix builds. Each sample column goes to
+    disk as probe ids and values as soon as it is added, and write streams
+    the TSV out of a memory mapped probes x samples matrix in row blocks, so
+    memory use depends on the number of probes and not on the number of
+    samples. Rows come out in the order pd.concat(axis=1) would give: as
+    read if every column had the same probes in the same order, otherwise
+    sorted. float32 halves the disk and IO, but can move the last printed
+    digit, float64 writes exactly what the in memory build does.
+    """
+    def __init__(self, path, dtype=np.float32, block_size=8192):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.block_size = block_size
+        self.known = pd.Index([])
+        self.first = None
+        self.aligned = True
+        self.indexNames = set()
+        self.columns = []
+        self.offset = 0
+        self.handle = open(os.path.join(self.path, "columns.bin"), "wb")
+
+    def probeIds(self, index):
+        ids = self.known.get_indexer(index)
+        missing = ids < 0
+        if missing.any():
+            new = pd.Index(index[missing]).unique()
+            self.known = self.known.append(pd.Index(new))
+            ids = self.known.get_indexer(index)
+        return ids.astype(np.int32)
+
+    def add(self, name, index, values):
+        if values.dtype.kind not in "iufb":
+            raise Exception("Matrix store can only hold numeric columns, %s is %s" % (name, values.dtype))
+        if self.first is None:
+            self.first = index
+        elif self.aligned and not index.equals(self.first):
+            self.aligned = False
+        self.indexNames.add(index.name)
+        ids = self.probeIds(index)
+        self.handle.write(ids.tostring())
+        self.handle.write(np.asarray(values, dtype=self.dtype).tostring())
+        #integer columns with every probe stay integers in pandas, and print that way
+        self.columns.append( [name, self.offset, len(ids), values.dtype.kind in "iub", False] )
+        self.offset += len(ids) * (4 + self.dtype.itemsize)
+
+    def drop(self, name):
+        for column in self.columns:
+            if column[0] == name:
+                column[4] = True
+
+    def columnNames(self):
+        return [ column[0] for column in self.columns if not column[4] ]
+
+    def write(self, handle, columns, float_format="%0.6g", jobs=1):
+        """
+        Write the matrix as TSV, byte for byte as DataFrame.to_csv would. columns is a
+        list of (position in columnNames, header name) in output order
+        """
+        self.handle.close()
+        live = [ column for column in self.columns if not column[4] ]
+        nrows = len(self.known)
+        if self.aligned:
+            order = np.arange(nrows)
+        else:
+            order = np.array(sorted(range(nrows), key=lambda i: self.known[i]), dtype=np.int64)
+        rowPos = np.empty(nrows, dtype=np.int64)
+        rowPos[order] = np.arange(nrows)
+        ncols = max(len(columns), 1)
+        matrix = np.memmap(os.path.join(self.path, "matrix.bin"), dtype=self.dtype, mode="w+", shape=(max(nrows, 1), ncols), order="F")
+        staged = np.memmap(os.path.join(self.path, "columns.bin"), dtype=np.uint8, mode="r") if self.offset else None
+        isInt = []
+        for j, (i, name) in enumerate(columns):
+            name, offset, length, integer, dropped = live[i]
+            ids = np.frombuffer(staged[offset:offset + length * 4], dtype=np.int32)
+            values = np.frombuffer(staged[offset + length * 4:offset + length * (4 + self.dtype.itemsize)], dtype=self.dtype)
+            col = np.empty(nrows, dtype=self.dtype)
+            col.fill(np.nan)
+            col[rowPos[ids]] = values
+            matrix[:nrows, j] = col
+            isInt.append(integer and len(np.unique(ids)) == nrows)
+        matrix.flush()
+        labels = self.known[order] if nrows else []
+        indexName = ""
+        if self.aligned and len(self.indexNames) == 1 and None not in self.indexNames:
+            indexName = list(self.indexNames)[0]
+        writer = TSVWriter([indexName] + [ name for i, name in columns ], tsvCells(np.asarray(labels), float_format),
+            [ matrix[:nrows, j] for j in range(len(columns)) ], [ "%d" if integer else float_format for integer in isInt ],
+            self.block_size)
+        writer.write(handle, jobs)
+        del matrix
+        del staged
+        shutil.rmtree(self.path, True)
+
+
+#bump when parseFile results change, so results cached by older code aren't used
+PARSE_CACHE_VERSION = 1
+
+class ParseCache(object):
+    """
+    Per file parse results kept between builds for build --incremental. A
+    file is known by its path inside its archive and the md5 the archive's
+    MANIFEST.txt lists for it, so when a new revision of an archive keeps a
+    file unchanged its result is loaded from here rather than parsed again.
+    files.json records the files the last build used, finish compares it
+    with this build's files and removes the results no longer used, which
+    is how dropped samples leave. Results are also keyed by PARSE_CACHE_VERSION
+    and the pandas version, which the pickles depend on.
+    """
+    def __init__(self, path, roots):
+        self.path = path
+        self.roots = roots
+        self.manifests = {}
+        self.files = {}
+        self.parsed = 0
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.previous = {}
+        if os.path.exists(os.path.join(self.path, "files.json")):
+            with open(os.path.join(self.path, "files.json")) as handle:
+                self.previous = json.load(handle)
+
+    def manifest(self, archiveDir):
+        if archiveDir not in self.manifests:
+            self.manifests[archiveDir] = readManifest(os.path.join(archiveDir, "MANIFEST.txt"))
+        return self.manifests[archiveDir]
+
+    def fileKey(self, path):
+        """The file's path inside its archive and its md5, from the manifest or, failing that, the file"""
+        for root in self.roots:
+            if path.startswith(root + os.sep):
+                parts = path[len(root) + 1:].split(os.sep, 1)
+                if len(parts) == 2:
+                    md5 = self.manifest(os.path.join(root, parts[0])).get(parts[1])
+                    if md5 is not None:
+                        return parts[1], md5
+                return parts[-1], fileDigest(path)
+        return path, fileDigest(path)
+
+    def resultPath(self, name, md5):
+        key = "%d\t%s\t%s\t%s" % (PARSE_CACHE_VERSION, pd.__version__, name, md5)
+        return os.path.join(self.path, hashlib.md5(key).hexdigest() + ".pkl")
+
+    def has(self, path):
+        if path not in self.files:
+            self.files[path] = self.fileKey(path)
+        return os.path.exists(self.resultPath(*self.files[path]))
+
+    def load(self, path):
+        with open(self.resultPath(*self.files[path]), "rb") as handle:
+            return pickle.load(handle)
+
+    def save(self, path, result):
+        self.parsed += 1
+        out = ProductWriter(self.resultPath(*self.files[path]))
+        pickle.dump(result, out, pickle.HIGHEST_PROTOCOL)
+        out.commit()
+
+    def finish(self):
+        current = dict( self.files.values() )
+        used = set( os.path.basename(self.resultPath(name, md5)) for name, md5 in current.items() )
+        for name in os.listdir(self.path):
+            if name.endswith(".pkl") and name not in used:
+                os.unlink(os.path.join(self.path, name))
+        added = len([ name for name in current if name not in self.previous ])
+        changed = len([ name for name in current if name in self.previous and self.previous[name] != current[name] ])
+        removed = len([ name for name in self.previous if name not in current ])
+        print "Incremental: %d files, %d added, %d changed, %d removed, %d parsed" % (len(current), added, changed, removed, self.parsed)
+        out = ProductWriter(os.path.join(self.path, "files.json"))
+        out.write(json.dumps(current))
+        out.commit()
+
+
 ############
 # Importer Classes
 ############
 
+#tar members staged by a --single-pass stream are kept in memory up to this size, larger ones spill to work_dir
+STAGE_MEMORY = 64 * 1024 * 1024
+
 class FileImporter:
     dataSubTypes = {}
     excludes = [
@@ -286,6 +1674,9 @@ class FileImporter:
     def __init__(self, config, build_req):
         self.config = config
         self.build_req = build_req
+        self.member = None
+        self.gzipCheckpoints = {}
+        self.excludePattern = None
     	#variable df, which is the data frame keeping all the data, it will be assigned in the run() method
         self.df = None
 
@@ -293,63 +1684,382 @@ class FileImporter:
         if not os.path.exists(self.config.workdir_base):
             os.makedirs(self.config.workdir_base)      
         self.work_dir = tempfile.mkdtemp(dir=self.config.workdir_base)
+        urls = [ record['url'] for record in self.build_req['provenance']['used'] ]
+        paths = self.config.fetchArchives(urls)
+        self.archive_urls = urls
+        self.archive_paths = paths
+        if self.config.stream:
+            print "Stream from", len(paths), "archives, work in", self.work_dir
+            return
+        if self.config.extract_cache is not None:
+            print "Extract to cache", self.config.extract_cache.path
+            self.scan_roots = self.mapArchives(self.cacheArchive, urls, paths)
+            return
         print "Extract to ", self.work_dir
-        for record in self.build_req['provenance']['used']:
-            url = record['url']
-            path = self.config.getURLPath(url)
-            subprocess.check_call([ "tar", "xzf", path, "-C", self.work_dir])#, stderr=sys.stdout)
+        self.scan_roots = [ self.work_dir ]
+        self.mapArchives(self.extractArchive, urls, paths)
+
+    def mapArchives(self, func, urls, paths):
+        jobs = min(self.config.extract_jobs, len(paths))
+        if jobs > 1:
+            #tar and the gzip decoder do the work, so threads are enough to keep the cores busy
+            pool = ThreadPool(jobs)
+            try:
+                return pool.map(lambda x: func(*x), zip(urls, paths))
+            finally:
+                pool.terminate()
+                pool.join()
+        return [ func(url, path) for url, path in zip(urls, paths) ]
+
+    def cacheArchive(self, url, path):
+        """Extracted tree for the archive, from the extract cache when it is unchanged"""
+        digest = self.config.md5index.digest(path)
+        #with --single-pass the archive is checked here, against the digest that keys the cache
+        if self.config.single_pass and not self.config.checkDigest(path, digest) and self.config.checksum_delete:
+            path = self.config.refetchArchive(url, path)
+            digest = self.config.md5index.digest(path)
+            if not self.config.checkDigest(path, digest):
+                raise Exception("Corrupt archive: %s" % (path))
+        return self.config.extract_cache.acquire(digest,
+            lambda dest: subprocess.check_call(tarCommand(path, dest, self.config.decoder)))
+
+    def extractArchive(self, url, path):
+        decoder = self.config.decoder
+        if not self.config.single_pass:
+            subprocess.check_call(tarCommand(path, self.work_dir, decoder))#, stderr=sys.stdout)
+            return
+        #extract beside work_dir first, so a corrupt archive can be thrown away whole
+        stage = tempfile.mkdtemp(dir=self.work_dir, prefix=".extract")
+        error = None
+        try:
+            digest = extractTar(path, stage, decoder=decoder)
+        except subprocess.CalledProcessError, e:
+            #tar gave up part way, the full digest says whether the archive is corrupt
+            digest = fileDigest(path)
+            error = e
+        if not self.config.checkDigest(path, digest) and self.config.checksum_delete:
+            #the bad copy is gone from the mirror, fetch a good one and extract it into a clean stage
+            shutil.rmtree(stage)
+            os.mkdir(stage)
+            path = self.config.refetchArchive(url, path)
+            digest = extractTar(path, stage, decoder=decoder)
+            if not self.config.checkDigest(path, digest):
+                raise Exception("Corrupt archive: %s" % (path))
+        elif error is not None:
+            raise error
+        mergeTree(stage, self.work_dir)
         
     def run(self):        
         self.extractTars()
-        #scan the magetab
-        self.out = {}
-        self.ext_meta = {}
-        self.scandirs(self.work_dir, None)
-        for o in self.out:
-            self.out[o].close()
-        for dsubtype in self.dataSubTypes:
-            self.df = pd.DataFrame()
-            print "Extracting: ", dsubtype
-            filterInclude = None
-            filterExclude = None
-            if 'fileInclude' in self.dataSubTypes[dsubtype]:
-                filterInclude = re.compile(self.dataSubTypes[dsubtype]['fileInclude'])
-            if 'fileExclude' in self.dataSubTypes[dsubtype]:
-                filterExclude = re.compile(self.dataSubTypes[dsubtype]['fileExclude'])
-            self.inc = 0
-            self.errors = []
-            self.ext_meta = {}
-            self.out = {}
-            self.scandirs(self.work_dir, dsubtype, filterInclude=filterInclude, filterExclude=filterExclude)
+        self.pool = None
+        try:
+            if self.config.stream:
+                #every archive is read once, for the magetab and all the dataSubTypes together
+                states = self.streamTars()
+            else:
+                self.manifest = self.buildManifest()
+                if self.config.jobs > 1 and getattr(self, "parseFile", None) is not None:
+                    self.pool = self.parsePool(self.config.jobs)
+            #scan the magetab
+            if self.config.stream:
+                self.loadState(states.pop(None))
+            else:
+                self.out = {}
+                self.ext_meta = {}
+                self.scan(None)
             for o in self.out:
                 self.out[o].close()
-            self.fileBuild(dsubtype)
+            for dsubtype in self.dataSubTypes:
+                print "Extracting: ", dsubtype
+                if self.config.stream:
+                    self.loadState(states.pop(dsubtype))
+                else:
+                    self.startPass()
+                    filterInclude, filterExclude = self.fileFilters(dsubtype)
+                    self.scan(dsubtype, filterInclude=filterInclude, filterExclude=filterExclude)
+                for o in self.out:
+                    self.out[o].close()
+                self.fileBuild(dsubtype)
+        finally:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None
         shutil.rmtree(self.work_dir)       
+        if self.config.extract_cache is not None:
+            self.config.extract_cache.release()
+
+    #what a pass builds up from the files it scans, for fileBuild to write out
+    passState = ("df", "columns", "segments", "store", "inc", "errors", "ext_meta", "out")
+
+    def startPass(self):
+        self.df = pd.DataFrame()
+        self.columns = []
+        self.segments = []
+        self.store = None
+        self.inc = 0
+        self.errors = []
+        self.ext_meta = {}
+        self.out = {}
+
+    def saveState(self):
+        return dict( (name, getattr(self, name)) for name in self.passState )
+
+    def loadState(self, state):
+        for name in self.passState:
+            setattr(self, name, state[name])
+
+    def fileFilters(self, dataSubType):
+        filterInclude = None
+        filterExclude = None
+        if 'fileInclude' in self.dataSubTypes[dataSubType]:
+            filterInclude = re.compile(self.dataSubTypes[dataSubType]['fileInclude'])
+        if 'fileExclude' in self.dataSubTypes[dataSubType]:
+            filterExclude = re.compile(self.dataSubTypes[dataSubType]['fileExclude'])
+        return filterInclude, filterExclude
     
     def checkExclude( self, name ):
-        for e in self.excludes:
-            if re.search( e, name ):
-                return True
-        return False
+        if self.excludePattern is None:
+            self.excludePattern = re.compile("|".join( "(?:%s)" % (e) for e in self.excludes ))
+        return self.excludePattern.search(name) is not None
+
+    def scan(self, dataSubType, filterInclude=None, filterExclude=None):
+        """Scan every file of the build, the magetab when dataSubType is None"""
+        if dataSubType is not None and (self.pool is not None or self.config.incremental is not None) and getattr(self, "parseFile", None) is not None:
+            paths = self.manifest[dataSubType]
+            #results come back in file order, so they merge exactly as a serial scan would
+            for path, result in self.parseFiles(paths, dataSubType):
+                self.mergeFile(path, dataSubType, result)
+        else:
+            for path in self.manifest[dataSubType]:
+                self.scanFile(path, dataSubType)
+
+    def parseFiles(self, paths, dataSubType):
+        """
+        (path, parseFile result) for each of paths, in order. With --incremental files the last
+        build parsed are loaded from its ParseCache and only the rest are parsed,
+        in the pool when there is one.
+        """
+        cache = None
+        todo = paths
+        if self.config.incremental is not None:
+            cache = ParseCache(os.path.join(self.config.incremental, self.__class__.__name__, self.config.name, dataSubType), self.scan_roots)
+            todo = [ path for path in paths if not cache.has(path) ]
+        if self.pool is not None:
+            parsed = self.pool.imap(parseWorker, [ (path, dataSubType) for path in todo ])
+        else:
+            parsed = ( self.parseFile(path, dataSubType) for path in todo )
+        todo = set(todo)
+        for path in paths:
+            if path not in todo:
+                yield path, cache.load(path)
+                continue
+            result = parsed.next()
+            if cache is not None:
+                cache.save(path, result)
+            yield path, result
+        if cache is not None:
+            cache.finish()
+
+    def parsePool(self, jobs):
+        """
+        Worker processes for importers that split fileScan into parseFile and
+        mergeFile. They are forked with a copy of this importer, so only the
+        paths go out and the parsed per-file results come back.
+        """
+        global parseImporter
+        parseImporter = self
+        return Pool(jobs)
+
+    def buildManifest(self):
+        """
+        Sort the files under the scan roots into the passes that will read them,
+        the magetab (None) and each dataSubType, in a single walk of the tree.
+        Files are listed in the order scandirs would have found them.
+        """
+        filters = [ (dsubtype,) + self.fileFilters(dsubtype) for dsubtype in self.dataSubTypes ]
+        manifest = dict( (dsubtype, []) for dsubtype in self.dataSubTypes )
+        manifest[None] = []
+        for root in self.scan_roots:
+            for path in walkFiles(root):
+                if self.isMage(path):
+                    manifest[None].append(path)
+                    continue
+                name = os.path.basename(path)
+                if self.checkExclude(name):
+                    continue
+                for dsubtype, filterInclude, filterExclude in filters:
+                    if (filterInclude is None or filterInclude.match(name)) and (filterExclude is None or not filterExclude.match(path)):
+                        manifest[dsubtype].append(path)
+        return manifest
           
-    def scandirs(self, path, dataSubType, filterInclude=None, filterExclude=None):
-        if os.path.isdir(path):
-            for a in glob(os.path.join(path, "*")):
-                self.scandirs(a, dataSubType, filterInclude, filterExclude)
+    def checkFile(self, path, dataSubType, filterInclude=None, filterExclude=None):
+        """Should the file at path be scanned in the pass for dataSubType, decided on the name alone"""
+        if self.isMage(path):
+            return dataSubType is None
+        if dataSubType is None or self.checkExclude(os.path.basename(path)):
+            return False
+        return (filterInclude is None or filterInclude.match(os.path.basename(path))) and (filterExclude is None or not filterExclude.match(path))
+
+    def scanFile(self, path, dataSubType):
+        if dataSubType is None:
+            self.mageScan(path)
         else:
-            name = os.path.basename(path)
-            if self.isMage(path):
-                if dataSubType is None:
-                    self.mageScan(path)
-            else:
-                if dataSubType is not None:
-                    if not self.checkExclude(name):
-                        if (filterInclude is None or filterInclude.match(name)) and (filterExclude is None or not filterExclude.match(path)):
-                            self.fileScan(path, dataSubType)
+            self.fileScan(path, dataSubType)
+
+    def streamTars(self):
+        """
+        Scan the archives for every pass at once, the magetab (None) and each
+        dataSubType, so each archive is only read a single time. Returns the
+        state each pass built up, for run to load before its fileBuild.
+        """
+        passes = [ (None, None, None) ] + [ (dsubtype,) + self.fileFilters(dsubtype) for dsubtype in self.dataSubTypes ]
+        states = {}
+        for dsubtype, filterInclude, filterExclude in passes:
+            self.startPass()
+            states[dsubtype] = self.saveState()
+        for i, path in enumerate(self.archive_paths):
+            if not self.config.single_pass:
+                self.streamTar(path, passes, states)
+                continue
+            #with --single-pass the md5 is checked on this read, so the members are staged
+            #and only scanned once the digest shows they came from a good copy
+            stage = []
+            try:
+                error = None
+                try:
+                    digest = self.streamTar(path, passes, states, stage=stage)
+                except (tarfile.TarError, IOError, EOFError, zlib.error), e:
+                    digest = fileDigest(path)
+                    error = e
+                if not self.config.checkDigest(path, digest) and self.config.checksum_delete:
+                    for member, wanted, handle in stage:
+                        handle.close()
+                    stage = []
+                    path = self.config.refetchArchive(self.archive_urls[i], path)
+                    self.archive_paths[i] = path
+                    if not self.config.checkDigest(path, self.streamTar(path, passes, states, stage=stage)):
+                        raise Exception("Corrupt archive: %s" % (path))
+                elif error is not None:
+                    raise error
+                for member, wanted, handle in stage:
+                    handle.seek(0)
+                    self.scanMember(member, handle, wanted, states)
+            finally:
+                for member, wanted, handle in stage:
+                    handle.close()
+        return states
+
+    def scanMember(self, member, handle, wanted, states):
+        """Scan the tar member read from handle in each of the wanted passes, with the state of that pass loaded"""
+        data = handle.read() if len(wanted) > 1 else None
+        for dsubtype in wanted:
+            self.loadState(states[dsubtype])
+            #each pass opens the member afresh, a stream can only be read once
+            self.member = (member, handle if data is None else io.BytesIO(data))
+            try:
+                self.scanFile(member, dsubtype)
+            finally:
+                self.member = None
+                states[dsubtype] = self.saveState()
+
+    def wantedPasses(self, member, passes):
+        return [ dsubtype for dsubtype, filterInclude, filterExclude in passes if self.checkFile(member, dsubtype, filterInclude, filterExclude) ]
+
+    def memberPath(self, name):
+        """Where a tar member would have been extracted in work_dir, None if it would land outside"""
+        member = os.path.normpath(os.path.join(self.work_dir, name.lstrip("/")))
+        if not member.startswith(self.work_dir + os.sep):
+            return None
+        return member
+
+    def indexedTar(self, path, passes, states):
+        """
+        Scan the wanted members of the tarball at path, found through its
+        TarIndex. An archive with nothing wanted isn't read at all, and the
+        rest are only inflated from the checkpoint nearest each member.
+        """
+        checkpoints = self.gzipCheckpoints.setdefault(path, [])
+        wanted = []
+        for name, offset, size in TarIndex.load(path, checkpoints).members:
+            member = self.memberPath(name)
+            if member is not None:
+                dsubtypes = self.wantedPasses(member, passes)
+                if len(dsubtypes):
+                    wanted.append( (offset, size, member, dsubtypes) )
+        if len(wanted) == 0:
+            return
+        reader = GzipReader(path, checkpoints)
+        try:
+            for offset, size, member, dsubtypes in sorted(wanted):
+                reader.seek(offset)
+                self.scanMember(member, io.BytesIO(reader.read(size)), dsubtypes, states)
+        finally:
+            reader.close()
+
+    def streamTar(self, path, passes, states, stage=None):
+        """
+        Scan the members of the tarball at path for passes, a list of (dataSubType,
+        filterInclude, filterExclude), without extracting it. Members are named as
+        if they had been extracted into work_dir and are checked on that name
+        before any of their data is read. With stage, the wanted members are
+        spooled into it as (member, dataSubTypes, handle) rather than scanned,
+        and the md5 of the tarball is returned.
+        """
+        if self.config.tar_index and stage is None:
+            return self.indexedTar(path, passes, states)
+        handle = open(path, "rb")
+        reader = DigestReader(handle) if stage is not None else handle
+        try:
+            tar = tarfile.open(fileobj=reader, mode="r|gz")
+            for info in tar:
+                if not info.isfile():
+                    continue
+                member = self.memberPath(info.name)
+                if member is None:
+                    continue
+                dsubtypes = self.wantedPasses(member, passes)
+                if len(dsubtypes) == 0:
+                    continue
+                if stage is None:
+                    self.scanMember(member, tar.extractfile(info), dsubtypes, states)
+                    continue
+                spool = tempfile.SpooledTemporaryFile(max_size=STAGE_MEMORY, dir=self.work_dir)
+                stage.append( (member, dsubtypes, spool) )
+                shutil.copyfileobj(tar.extractfile(info), spool)
+            tar.close()
+            if stage is not None:
+                return reader.hexdigest()
+        finally:
+            handle.close()
+
+    def openFile(self, path, mode="r"):
+        """
+        Open a file found by the scan. When streaming, path names the current tar
+        member, which is read into memory rather than written out to disk.
+        """
+        if self.member is None or self.member[0] != path:
+            return open(path, mode)
+        data = self.member[1].read()
+        #the member can't be read twice out of the stream, keep it for localPath or another open
+        self.member = (path, io.BytesIO(data))
+        if 'U' in mode:
+            data = data.replace("\r\n", "\n").replace("\r", "\n")
+        return io.BytesIO(data)
+
+    def localPath(self, path):
+        """A real file for path, when streaming the current tar member is written out to it"""
+        if self.member is None or self.member[0] != path:
+            return path
+        dir = os.path.dirname(path)
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        with open(path, "wb") as handle:
+            shutil.copyfileobj(self.member[1], handle)
+        return path
                         
     def isMage(self, path):
-        if path.endswith( '.sdrf.txt' ) or path.endswith( '.idf.txt' ) or path.endswith("DESCRIPTION.txt"):
-            return True
+        return path.endswith( ('.sdrf.txt', '.idf.txt', "DESCRIPTION.txt") )
 
     
     def emit(self, key, data, port):
@@ -357,19 +2067,66 @@ class FileImporter:
             self.out[port] = open(self.work_dir + "/" + port, "w")
         self.out[port].write( "%s\t%s\n" % (key, json.dumps(data)))
 
+    def writeTSV(self, df, handle, index=True, float_format="%0.6g"):
+        """df.to_csv(handle, sep="\t", ...) through a TSVWriter, formatting with --jobs processes"""
+        writer = TSVWriter.fromFrame(df, index=index, float_format=float_format)
+        if writer is None:
+            df.to_csv(handle, sep="\t", index=index, float_format=float_format)
+        else:
+            writer.write(handle, self.config.jobs)
+
+    def openOutput(self, dataSubType, meta):
+        """
+        A ProductWriter for the output of dataSubType, for fileBuild to write the
+        product straight into the output directory and then hand to emitFile.
+        """
+        outPath = self.config.getOutPath(self.dataSubTypes[dataSubType]['nameGen'])
+        compress = None
+        if meta['annotations'].get('fileType') in TABLE_FILE_TYPES:
+            compress = self.config.compress
+        if compress is not None:
+            #the .gz goes on the name too, synapseLoad_files uploads whatever the .json sits next to
+            outPath += ".gz"
+            meta['name'] += ".gz"
+        return ProductWriter(outPath, compress, self.config.bgzip)
+
     def emitFile(self, dataSubType, meta, file):
-        md5 = hashlib.md5()
-        oHandle = open(self.config.getOutPath(self.dataSubTypes[dataSubType]['nameGen']), "wb")
-        with open(file,'rb') as f: 
-            for chunk in iter(lambda: f.read(8192), ''): 
-                md5.update(chunk)
-                oHandle.write(chunk)
-        oHandle.close()
-        md5str = md5.hexdigest()
-        meta['annotations']['md5'] = md5str
-        mHandle = open(self.config.getOutMeta(self.dataSubTypes[dataSubType]['nameGen']), "w")
+        """
+        Put a product in place and write its .json. file is the ProductWriter
+        fileBuild wrote it through, or the path of a file to hard link in, or
+        copy when it can't be linked, has to be compressed or is in the extract
+        cache, which couldn't reclaim the space while the product links to it.
+        """
+        if isinstance(file, ProductWriter):
+            product = file
+        else:
+            product = self.openOutput(dataSubType, meta)
+            cached = self.config.extract_cache is not None and self.config.extract_cache.contains(file)
+            if product.compress is not None or cached or not product.linkFrom(file):
+                with open(file,'rb') as f: 
+                    for chunk in iter(lambda: f.read(1024*1024), ''): 
+                        product.write(chunk)
+        product.close()
+        product.commit()
+        meta['annotations']['md5'] = product.md5
+        if product.compress is not None:
+            meta['compression'] = {
+                'format' : product.compress,
+                'size' : product.size,
+                'uncompressedSize' : product.rawSize
+            }
+        if self.config.binary is not None and meta['annotations'].get('fileType') in TABLE_FILE_TYPES:
+            binPath = self.config.getOutPath(self.dataSubTypes[dataSubType]['nameGen']) + BINARY_FORMATS[self.config.binary][0]
+            writeBinary(product.path, binPath, meta['annotations']['fileType'], self.config.binary)
+            meta['binary'] = {
+                'format' : self.config.binary,
+                'file' : os.path.basename(binPath),
+                'md5' : fileDigest(binPath)
+            }
+        mHandle = ProductWriter(product.path + ".json")
         mHandle.write( json.dumps(meta))
         mHandle.close()
+        mHandle.commit()
         if len(self.errors):
             eHandle = open( self.config.getOutError(dataSubType), "w" )
             for msg in self.errors:
@@ -402,7 +2159,7 @@ class TCGAGeneticImport(FileImporter):
     
     def mageScan(self, path):
         if path.endswith(".sdrf.txt"):
-            iHandle = open(path, "rU")
+            iHandle = self.openFile(path, "rU")
             read = csv.reader( iHandle, delimiter="\t" )
             colNum = None
             for row in read:
@@ -429,7 +2186,7 @@ class TCGAGeneticImport(FileImporter):
                         except IndexError:
                             pass #there can be blank lines in the SDRF
         if path.endswith(".idf.txt"):
-            iHandle = open(path)
+            iHandle = self.openFile(path)
             for line in iHandle:
                 row = line.split("\t")
                 if len(row):
@@ -437,7 +2194,7 @@ class TCGAGeneticImport(FileImporter):
                         self.ext_meta[ idfMap[row[0]] ] = row[1]
             iHandle.close()
         if path.endswith("DESCRIPTION.txt"):
-            handle = open(path)
+            handle = self.openFile(path)
             self.description = handle.read()
             handle.close()
     
@@ -484,6 +2241,48 @@ class TCGAGeneticImport(FileImporter):
 
     def translateUUID(self, uuid):
         return self.config.translateUUID(uuid)
+
+    def addColumns(self, tmp):
+        """
+        Queue the columns read from one sample file. Concatenating them onto
+        self.df one file at a time copies the growing matrix on every file,
+        so they are joined in a single pd.concat by assembleColumns.
+        With --matrix-store they go straight to disk instead.
+        """
+        if self.config.matrix_store:
+            if self.store is None:
+                self.store = MatrixStore(tempfile.mkdtemp(dir=self.work_dir), self.config.matrix_store)
+            for i in range(tmp.shape[1]):
+                self.store.add(tmp.columns[i], tmp.index, tmp.iloc[:, i].values)
+            return
+        self.columns.append(tmp)
+
+    def dropColumn(self, key):
+        #the probes the dropped column brought in stay in the index, as they did with self.df.drop
+        if self.store is not None:
+            self.store.drop(key)
+            return
+        self.columns = [ tmp.drop(key, 1) if key in tmp.columns else tmp for tmp in self.columns ]
+
+    def assembleColumns(self):
+        if len(self.columns):
+            self.df = pd.concat([self.df] + self.columns, axis=1)
+            self.columns = []
+
+    def readProbeColumns(self, handle, names, dataSubType, indexName=None):
+        """
+        Read the rest of a level 3 file laid out as names, for a dataSubType
+        with projectColumns set: only the key (first) column and the probeFields
+        columns are parsed. The dtypes are inferred as usual, so this returns the
+        same frame as reading every column and selecting the probeFields from it.
+        """
+        fields = self.dataSubTypes[dataSubType]['probeFields']
+        usecols = [0] + [ i for i in range(1, len(names)) if names[i] in fields ]
+        tmp = pd.read_csv(handle, sep="\t", header=None, usecols=usecols)
+        tmp = tmp.set_index(0)
+        tmp.index.name = indexName
+        tmp.columns = [ names[i] for i in usecols[1:] ]
+        return tmp
     
 
     def getTargetMap(self):
@@ -495,13 +2294,18 @@ class TCGAGeneticImport(FileImporter):
     
 
     def fileScan(self, path, dataSubType):
+        self.mergeFile(path, dataSubType, self.parseFile(path, dataSubType))
+
+    def mergeFile(self, path, dataSubType, tmp):
+        self.addColumns(tmp)
+
+    def parseFile(self, path, dataSubType):
         """
         This function takes a TCGA level 3 genetic file (file name and input handle),
         and tries to extract probe levels or target mappings (experimental ID to TCGA barcode)
-        it emits these values to a handle, using the 'targets' and 'probes' string to identify 
-        the type of data being emited
+        it returns them as a data frame, for mergeFile to add to the build
         """
-        iHandle = open(path)
+        iHandle = self.openFile(path)
         mode = None
         #modes
         #1 - segmentFile - one sample per file/no sample info inside file
@@ -527,22 +2331,29 @@ class TCGAGeneticImport(FileImporter):
             secondLine = iHandle.readline()
             colType = secondLine.rstrip().split("\t")
             colType = [commonMap.get(colType[i], colType[i]) for i in range(len(colType))]
-            tmp = pd.read_csv(iHandle, sep="\t", header=None, names=colType[1:], index_col=0)
-            wantedProbeFields = self.dataSubTypes[dataSubType]['probeFields']
-            idx = [col in wantedProbeFields for col in colType]
-            idx = idx[1:]
-            tmp = tmp.ix[:,idx]
+            if self.dataSubTypes[dataSubType].get('projectColumns'):
+                tmp = self.readProbeColumns(iHandle, colType, dataSubType)
+            else:
+                tmp = pd.read_csv(iHandle, sep="\t", header=None, names=colType[1:], index_col=0)
+                wantedProbeFields = self.dataSubTypes[dataSubType]['probeFields']
+                idx = [col in wantedProbeFields for col in colType]
+                idx = idx[1:]
+                tmp = tmp.ix[:,idx]
             tmp.columns = [colName[1]]
             tmp = tmp.dropna()
-            self.df = pd.concat([self.df, tmp], axis=1)
+            return tmp
+        elif mode is None and self.dataSubTypes[dataSubType].get('projectColumns'):
+            tmp = self.readProbeColumns(iHandle, colName, dataSubType, indexName=colName[0])
+            tmp.columns = [os.path.basename(path).split(".")[0]]
+            return tmp
         else:
             tmp = pd.read_csv(iHandle, sep="\t", header=None, names=colName, index_col=0)
             tmp["file"] = os.path.basename(path)
             if mode==1:
                 tmp["key"] = target
-                self.df = pd.concat([self.df,tmp], axis=1)
+                return tmp
             elif mode == 3:
-                self.df = pd.concat([self.df, tmp], axis=1)
+                return tmp
             else:
                 tmp = tmp.drop("file", 1)
                 wantedProbeFields = self.dataSubTypes[dataSubType]['probeFields']
@@ -550,25 +2361,32 @@ class TCGAGeneticImport(FileImporter):
                 idx = idx[1:]
                 tmp = tmp.ix[:,idx]
                 tmp.columns = [os.path.basename(path).split(".")[0]]
-                self.df = pd.concat([self.df, tmp], axis=1)
+                return tmp
 
 
 class TCGASegmentImport(TCGAGeneticImport):
 
-    def fileScan(self, path, dataSubType):
+    def parseFile(self, path, dataSubType):
         """
         This function takes a TCGA level 3 genetic file (file name and input handle),
         and tries to extract probe levels or target mappings (experimental ID to TCGA barcode)
-        it emits these values to a handle, using the 'targets' and 'probes' string to identify 
-        the type of data being emitted
+        it returns the segments as a data frame, for mergeFile to add to the build
         """
-        with open(path,'U') as iHandle:
+        with self.openFile(path,'U') as iHandle:
             tmp = pd.read_csv(iHandle, sep="\t", header=0, dtype='object')
         
         tmp['key'] = os.path.basename(path)
         tmp.columns = [commonMap.get(col, col) for col in tmp.columns] 
-        self.df = self.df.append(tmp[["chrom", "loc.start", "loc.end", "key", "seg.mean"]])
-        self.df = self.df[["chrom", "loc.start", "loc.end", "key", "seg.mean"]] #Fix order to be bed5 compatible
+        return tmp[["chrom", "loc.start", "loc.end", "key", "seg.mean"]]
+
+    def mergeFile(self, path, dataSubType, tmp):
+        self.segments.append(tmp)
+
+    def assembleSegments(self, columns):
+        """Stack the segments of every file in one pd.concat, columns fixes their order"""
+        if len(self.segments):
+            self.df = pd.concat([self.df] + self.segments).ix[:, columns]
+            self.segments = []
 
 
     def getMeta(self, name, dataSubType):
@@ -592,7 +2410,7 @@ class TCGASegmentImport(TCGAGeneticImport):
         #use the target table to create a name translation table
         #also setup target name enumeration, so they will have columns
         #numbers         
-        segFile = "%s/%s.segment_file"  % (self.work_dir, dataSubType)
+        self.assembleSegments(["chrom", "loc.start", "loc.end", "key", "seg.mean"]) #Fix order to be bed5 compatible
         tmap = self.getTargetMap()
 
         self.df["key"] = [self.translateUUID(tmap.get(key, key).lower()) for key in self.df["key"]]
@@ -603,9 +2421,11 @@ class TCGASegmentImport(TCGAGeneticImport):
             self.df = self.df[idx]
         self.df = self.df[['key', 'chrom', 'loc.start', 'loc.end', 'seg.mean']]
         self.df.columns = ['Sample', 'Chromosome', 'Start', 'End', 'Segment_Mean']
-        self.df.to_csv(segFile, index=False, sep="\t", float_format="%0.6g")     
         matrixName = self.config.name
-        self.emitFile( dataSubType, self.getMeta(matrixName, dataSubType), segFile)
+        meta = self.getMeta(matrixName, dataSubType)
+        segFile = self.openOutput(dataSubType, meta)
+        self.writeTSV(self.df, segFile, index=False)
+        self.emitFile( dataSubType, meta, segFile)
 
 
 class TCGAMatrixImport(TCGAGeneticImport):
@@ -632,6 +2452,7 @@ class TCGAMatrixImport(TCGAGeneticImport):
         #also setup target name enumeration, so they will have columns
         #numbers 
         matrixFile = None
+        self.assembleColumns()
         f=open(self.work_dir +"/targets", "r")
         d = dict()
         for line in f:
@@ -640,6 +2461,8 @@ class TCGAMatrixImport(TCGAGeneticImport):
             d[arr[0]] = arr[1].strip("\"").strip(".SD")
         f.close()
         d["key"] = "probes"
+        if self.config.matrix_store:
+            return self.storeBuild(dataSubType, d)
 	self.df.columns = [ self.translateUUID(d.get(key, key)) for key in self.df.columns]
         if self.config.rmControl: #Filter out control samples
             newCols = [col for col in self.df.columns if not any([col.startswith(item) for item in CONTROL_SAMPLES])]
@@ -648,21 +2471,37 @@ class TCGAMatrixImport(TCGAGeneticImport):
         sortedCol = sorted(list(set(self.df.columns)))
         self.df = self.df.ix[:, sortedCol]
         #self.df = self.df.ix[sortedIndex, sortedCol]
-        matrixFile = "%s/%s.matrix_file" % (self.work_dir, dataSubType)
-        self.df.to_csv(matrixFile, header=True, sep="\t", index=True, float_format="%0.6g")
         matrixName = self.config.name    
-        self.emitFile( dataSubType, self.getMeta(matrixName, dataSubType), matrixFile) 
+        meta = self.getMeta(matrixName, dataSubType)
+        matrixFile = self.openOutput(dataSubType, meta)
+        self.writeTSV(self.df, matrixFile, index=True)
+        self.emitFile( dataSubType, meta, matrixFile) 
+
+    def storeBuild(self, dataSubType, d):
+        """fileBuild for --matrix-store, the same column renaming, filtering and sorting, done on the store"""
+        if self.store is None:
+            self.store = MatrixStore(tempfile.mkdtemp(dir=self.work_dir), self.config.matrix_store)
+        names = [ self.translateUUID(d.get(key, key)) for key in self.store.columnNames() ]
+        keep = range(len(names))
+        if self.config.rmControl: #Filter out control samples
+            keep = [i for i in keep if not any([names[i].startswith(item) for item in CONTROL_SAMPLES])]
+        #a stable sort keeps columns with the same name in the order they were read, as .ix does
+        keep = sorted(keep, key=lambda i: names[i])
+        meta = self.getMeta(self.config.name, dataSubType)
+        matrixFile = self.openOutput(dataSubType, meta)
+        self.store.write(matrixFile, [ (i, names[i]) for i in keep ], float_format="%0.6g", jobs=self.config.jobs)
+        self.store = None
+        self.emitFile( dataSubType, meta, matrixFile)
 
 class TCGASegmentImport_HumanHap(TCGASegmentImport):
     
-    def fileScan(self, path, dataSubType):
+    def parseFile(self, path, dataSubType):
         """
         This function takes a TCGA level 3 genetic file (file name and input handle),
         and tries to extract probe levels or target mappings (experimental ID to TCGA barcode)
-        it emits these values to a handle, using the 'targets' and 'probes' string to identify 
-        the type of data being emited
+        it returns the segments as a data frame, for mergeFile to add to the build
         """
-        with open(path,'U') as iHandle:
+        with self.openFile(path,'U') as iHandle:
             tmp = pd.read_csv(iHandle, sep="\t", header=0, dtype='object')
         
         colNames = list(tmp.columns)
@@ -670,8 +2509,7 @@ class TCGASegmentImport_HumanHap(TCGASegmentImport):
         colNames[0] = "key"
         tmp.columns = colNames
         tmp.columns = [commonMap.get(col, col) for col in tmp.columns] 
-        self.df = self.df.append(tmp[["chrom", "loc.start", "loc.end", "key", "seg.mean"]])
-        self.df = self.df.ix[:,["chrom", "loc.start", "loc.end", "key", "seg.mean"]]
+        return tmp[["chrom", "loc.start", "loc.end", "key", "seg.mean"]]
 
 adminNS = "http://tcga.nci/bcr/xml/administration/2.3"
 
@@ -701,7 +2539,7 @@ class TCGAClinicalImport(FileImporter):
     
     def fileScan(self, path, dataSubType):
         print "Parsing", dataSubType, path
-        handle = open(path)
+        handle = self.openFile(path)
         data = handle.read()
         handle.close()
         xml=parseString(data)
@@ -888,7 +2726,8 @@ class TCGAClinicalImport(FileImporter):
                         if not self.config.sanitize or col not in [ 'race', 'ethnicity' ]:
                             colEnum[col] = len(colEnum)
             
-            handle = open( os.path.join(self.work_dir, dataSubType + "_file"), "w")
+            meta = self.getMeta(self.config.name, dataSubType)
+            handle = self.openOutput(dataSubType, meta)
             cols = [None] * (len(colEnum))
             for col in colEnum:
                 cols[colEnum[col]] = col
@@ -899,8 +2738,7 @@ class TCGAClinicalImport(FileImporter):
                     if col in matrix[key]:
                         cols[colEnum[col]] = matrix[key][col]['value']
                 handle.write("%s\t%s\n" % (key, "\t".join(cols).encode("ASCII", "replace")))
-            handle.close()
-            self.emitFile( dataSubType, self.getMeta(self.config.name, dataSubType), "%s/%s_file"  % (self.work_dir, dataSubType)) 
+            self.emitFile( dataSubType, meta, handle)
 
 
 class AgilentImport(TCGAMatrixImport):
@@ -967,26 +2805,25 @@ class SNP6Import(TCGASegmentImport):
     }
     
 
-    def fileScan(self, path, dataSubType):
-        with open(path) as handle:
+    def parseFile(self, path, dataSubType):
+        with self.openFile(path) as handle:
             tmp = pd.read_csv(handle, sep="\t", dtype='object')
-        tmp = tmp.ix[:, ['Sample', 'Chromosome', 'Start', 'End', 'Num_Probes', 'Segment_Mean']]
-        self.df = self.df.append(tmp)
-        self.df = self.df.ix[:,['Sample', 'Chromosome', 'Start', 'End', 'Num_Probes', 'Segment_Mean']]
+        return tmp.ix[:, ['Sample', 'Chromosome', 'Start', 'End', 'Num_Probes', 'Segment_Mean']]
 
 
     def fileBuild(self, dataSubType):
+        self.assembleSegments(['Sample', 'Chromosome', 'Start', 'End', 'Num_Probes', 'Segment_Mean'])
         tmap = self.getTargetMap()
-        segFile = "%s/%s.out"  % (self.work_dir, dataSubType)
         self.df["Sample"] = [self.translateUUID(tmap.get(key, key)) for key in self.df["Sample"]]
 	# Convert Num_Probes and Start cols to type int to remove decimal point
 	self.df['Num_Probes'] = self.df['Num_Probes'].astype(int)	
 	self.df['Start'] = self.df['Start'].astype(int)
         if self.config.rmControl: #Filter out control samples
             idx = [not any([k.startswith(item) for item in CONTROL_SAMPLES]) for k in self.df['Chromosome']]
-        self.df.to_csv(segFile, index=False, sep="\t", float_format="%0.6g")     
         meta = self.getMeta(self.config.name + ".hg19", dataSubType)
         meta['annotations']['assembly'] = { "@id" : 'hg19' }
+        segFile = self.openOutput(dataSubType, meta)
+        self.writeTSV(self.df, segFile, index=False)
         self.emitFile(dataSubType, meta, segFile)
        
 
@@ -1056,6 +2893,7 @@ class HT_HGU133A(TCGAMatrixImport):
             'dataType' : 'genomicMatrix',
             'fileExclude' : r'.*targets$|.*README.*.txt',
             'probeFields' : ['Signal', 'Value'],
+            'projectColumns' : True,
             'extension' : 'tsv',
             'nameGen' : lambda x : "%s.geneExp.tsv" % (x)
         }
@@ -1076,13 +2914,13 @@ class HuEx1_0stv2(TCGAMatrixImport):
         }
     }
 
-    def fileScan(self, path, dataSubType):
-        with open(path, "U") as iHandle:
+    def parseFile(self, path, dataSubType):
+        with self.openFile(path, "U") as iHandle:
             colName = iHandle.readline().rstrip().split("\t")
             tmp = pd.read_csv(iHandle, sep="\t", header=0, index_col=0)
         tmp.columns = colName[1:]
 	tmp = tmp.dropna()
-        self.df = pd.concat([self.df, tmp], axis=1)
+        return tmp
 
 class Human1MDuoImport(TCGASegmentImport_HumanHap):
     dataSubTypes = {
@@ -1118,6 +2956,7 @@ class HumanMethylation27(TCGAMatrixImport):
             'dataType' : 'genomicMatrix',
             'fileExclude' : '.*.adf.txt|^.*idf.txt|^.*sdrf.txt|^.*targets$',
             'probeFields' : ['Beta_Value', 'Beta_value'],
+            'projectColumns' : True,
             'extension' : 'tsv',
             'nameGen' : lambda x : "%s.betaValue.tsv" % (x)
         }
@@ -1132,31 +2971,37 @@ class HumanMethylation450(TCGAMatrixImport):
             'dataType' : 'genomicMatrix',
             'fileExclude' : '.*.adf.txt|^.*idf.txt|^.*sdrf.txt|^.*targets$',
             'probeFields' :  ['Beta_value', 'Beta_Value'],
+            'projectColumns' : True,
             'extension' : 'tsv',
             'nameGen' : lambda x : "%s.betaValue.tsv" % (x)
         }
     }
 
-    def fileScan(self, path, dataSubType):
+    def parseFile(self, path, dataSubType):
         """
         This function takes a TCGA level 3 genetic file (file name and input handle),
         and tries to extract probe levels or target mappings (experimental ID to TCGA barcode)
-        it emits these values to a handle, using the 'targets' and 'probes' string to identify 
-        the type of data being emited
+        it returns the sample's column, named by its barcode, for mergeFile
         """
-        with open(path) as iHandle:
+        with self.openFile(path) as iHandle:
             key = iHandle.readline().rstrip().split("\t")[1]
             colName = iHandle.readline().rstrip().split("\t")
             colName[0] = "key"              
-            tmp = pd.read_csv(iHandle, sep="\t", header=None, names=colName, index_col=0)
-        wantedFields = self.dataSubTypes[dataSubType]['probeFields']
-        idx = [col in wantedFields for col in colName][1:]
-        tmp = tmp.ix[:, idx]
+            if self.dataSubTypes[dataSubType].get('projectColumns'):
+                tmp = self.readProbeColumns(iHandle, colName, dataSubType, indexName="key")
+            else:
+                tmp = pd.read_csv(iHandle, sep="\t", header=None, names=colName, index_col=0)
+                wantedFields = self.dataSubTypes[dataSubType]['probeFields']
+                idx = [col in wantedFields for col in colName][1:]
+                tmp = tmp.ix[:, idx]
         tmp.columns = [key]
         tmp = tmp.dropna()
-        if not self.df.empty and key in self.df.columns:
-            self.df=self.df.drop(key, 1)
-        self.df = pd.concat([self.df, tmp], axis=1)
+        return tmp
+
+    def mergeFile(self, path, dataSubType, tmp):
+        #a barcode seen again replaces the earlier file's column
+        self.dropColumn(tmp.columns[0])
+        self.addColumns(tmp)
         
 class Illumina_RNASeq(TCGAMatrixImport):
     dataSubTypes = {
@@ -1164,6 +3009,7 @@ class Illumina_RNASeq(TCGAMatrixImport):
             'sampleMap' : 'tcga.iddag',
             'fileInclude' : r'^.*\.gene.quantification.txt$|^.*sdrf.txt$',
             'probeFields' : ['RPKM'],
+            'projectColumns' : True,
             'probeMap' : 'hugo.unc',
             'extension' : 'tsv',
             'nameGen' : lambda x : "%s.geneExp.tsv" % (x)
@@ -1176,6 +3022,7 @@ class Illumina_RNASeqV2(TCGAMatrixImport):
             'sampleMap' : 'tcga.iddag',
             'fileInclude' : r'^.*rsem.genes.normalized_results$|^.*sdrf.txt$',
             'probeFields' : ['normalized_count'],
+            'projectColumns' : True,
             'probeMap' : 'hugo.unc',
             'extension' : 'tsv',
             'nameGen' : lambda x : "%s.geneExp.tsv" % (x)
@@ -1184,20 +3031,25 @@ class Illumina_RNASeqV2(TCGAMatrixImport):
             'sampleMap' : 'tcga.iddag',
             'fileInclude' : r'^.*rsem.isoforms.results$',
             'probeFields' : ['raw_count'],
+            'projectColumns' : True,
             'probeMap' : 'ucsc.id',
             'extension' : 'tsv',
             'nameGen' : lambda x : "%s.isoformExp.tsv" % (x)
         }
     }
-    def fileScan(self, path, dataSubType):
+    def parseFile(self, path, dataSubType):
         
-        with open(path, 'U') as iHandle: 
-            tmp = pd.read_csv(iHandle, sep="\t", header=0, index_col=0)    
+        with self.openFile(path, 'U') as iHandle: 
+            if self.dataSubTypes[dataSubType].get('projectColumns'):
+                colName = iHandle.readline().rstrip("\n").split("\t")
+                tmp = self.readProbeColumns(iHandle, colName, dataSubType, indexName=colName[0])
+            else:
+                tmp = pd.read_csv(iHandle, sep="\t", header=0, index_col=0)    
         fname = os.path.basename(path)
         wantedFields = self.dataSubTypes[dataSubType]['probeFields']
         tmp = tmp.ix[:,wantedFields]
         tmp.columns = [fname]
-        self.df = pd.concat([self.df, tmp], axis=1)
+        return tmp
 
 class IlluminaHiSeq_RNASeq(TCGAMatrixImport):
     dataSubTypes = {
@@ -1207,6 +3059,7 @@ class IlluminaHiSeq_RNASeq(TCGAMatrixImport):
             'fileExclude' : (r'^.*bcgsc.ca_OV.IlluminaHiSeq_RNASeq.*hg19.gene.quantification.txt$|'
                               '^.*bcgsc.ca_STAD.IlluminaHiSeq_RNASeq.*[^v2].gene.quantification.txt'),
             'probeFields' : ['RPKM'],
+            'projectColumns' : True,
             'probeMap' : 'hugo.unc',
             'extension' : 'tsv',
             'nameGen' : lambda x : "%s.geneExp.tsv" % (x)
@@ -1244,6 +3097,7 @@ class Illumina_miRNASeq(TCGAMatrixImport):
                              '^.*READ.*hg19.mirna.quantification.txt$|'
                              '^.*LAML.*hg19.mirna.quantification.txt$'),  #Special case for COAD/OV/READ having two sets of files
             'probeFields' : ['reads_per_million_miRNA_mapped'],
+            'projectColumns' : True,
             'probeMap' : 'hsa.mirna',
             'extension' : 'tsv',
             'nameGen' : lambda x : "%s.miRNAExp.tsv" % (x)
@@ -1325,11 +3179,11 @@ class MafImport(FileImporter):
         return fileInfo
     
     def fileScan(self, path, dataSubType):
-        self.emitFile(dataSubType, self.getMeta(self.config.name, dataSubType), path)
+        self.emitFile(dataSubType, self.getMeta(self.config.name, dataSubType), self.localPath(path))
 
     def mageScan(self, path):
         if path.endswith(".idf.txt"):
-            iHandle = open(path)
+            iHandle = self.openFile(path)
             for line in iHandle:
                 row = line.split("\t")
                 if len(row):
@@ -1337,7 +3191,7 @@ class MafImport(FileImporter):
                         self.ext_meta[ idfMap[row[0]] ] = row[1]
             iHandle.close()
         if path.endswith("DESCRIPTION.txt"):
-            handle = open(path)
+            handle = self.openFile(path)
             self.description = handle.read()
             handle.close()
 
@@ -1463,13 +3317,694 @@ def dict_merge(x, y):
     return result
 
 
-def fileDigest( file ):
-    md5 = hashlib.md5()
+def fileDigest( file, md5=None ):
+    if md5 is None:
+        md5 = hashlib.md5()
     with open(file,'rb') as f: 
-        for chunk in iter(lambda: f.read(8192), ''): 
+        for chunk in iter(lambda: f.read(1024*1024), ''): 
             md5.update(chunk)
     return md5.hexdigest()
 
+#the importer a parsePool worker was forked from
+parseImporter = None
+
+def parseWorker( args ):
+    path, dataSubType = args
+    return parseImporter.parseFile(path, dataSubType)
+
+#the TSVWriter a write worker was forked from
+tsvWriter = None
+
+TSV_QUOTE = re.compile(r'[\t"\r\n]')
+TSV_NAN = re.compile(r'(?<![^\t\n])nan(?=[\t\n])')
+
+def tsvWorker( start ):
+    return tsvWriter.block(start)
+
+def tsvCells( values, float_format ):
+    """The cells to_csv writes for an array of values or labels, nulls left empty"""
+    if values.dtype.kind == "f" and float_format is not None:
+        return [ "" if v != v else float_format % v for v in values.tolist() ]
+    if values.dtype.kind == "O" or values.dtype.kind == "f":
+        return [ "" if null else v for v, null in zip(values.tolist(), pd.isnull(values).tolist()) ]
+    return values.astype(str).tolist()
+
+#binary output format : (file suffix, module it needs)
+BINARY_FORMATS = {
+    "hdf5" : (".h5", "tables"),
+    "parquet" : (".parquet", "pyarrow")
+}
+
+#tabular products, by annotations fileType, that get binary copies and compression
+TABLE_FILE_TYPES = [ "genomicMatrix", "seg", "clinicalMatrix" ]
+
+def binaryAvailable( format ):
+    try:
+        __import__(BINARY_FORMATS[format][1])
+    except ImportError:
+        return False
+    return True
+
+def uniqueNames( names ):
+    """Column names made unique the way read_csv mangles duplicates, binary formats need them unique"""
+    out = []
+    seen = {}
+    for name in names:
+        name = str(name)
+        if name in seen:
+            seen[name] += 1
+            name = "%s.%d" % (name, seen[name])
+        else:
+            seen[name] = 0
+        out.append(name)
+    return out
+
+#value columns per HDF5 node, bounds the memory a wide matrix takes to convert
+HDF5_GROUP_COLUMNS = 1000
+
+def readBinaryChunks( path, fileType, chunk_size=10000 ):
+    """
+    Read a TSV product back as typed frames: matrices in blocks of rows with string
+    probe ids and float64 values, so every block has the same column types, and
+    segments and clinical matrices whole, with read_csv picking the column types.
+    With chunk_size None a matrix is read whole and typed by read_csv too
+    """
+    if fileType != "genomicMatrix":
+        yield pd.read_csv(path, sep="\t", index_col=0 if fileType == "clinicalMatrix" else None)
+        return
+    with openProduct(path) as handle:
+        header = csv.reader(handle, delimiter="\t").next()
+    names = uniqueNames(header[1:])
+    dtype = { 0 : object }
+    if chunk_size is not None:
+        dtype.update( (i, np.float64) for i in range(1, len(header)) )
+    reader = pd.read_csv(path, sep="\t", header=None, skiprows=1, names=range(len(header)), index_col=0,
+        dtype=dtype, chunksize=chunk_size)
+    for chunk in (reader if chunk_size is not None else [reader]):
+        chunk.columns = names
+        chunk.index.name = header[0] if header[0] != "" else None
+        yield chunk
+
+def readColumnGroups( path, fileType, group_size=HDF5_GROUP_COLUMNS ):
+    """
+    Read a TSV product back whole as typed frames of at most group_size value
+    columns each, with read_csv picking the column types. Segments come back
+    as one frame, matrices and clinical matrices keep their row labels as the index
+    """
+    if fileType == "seg":
+        yield pd.read_csv(path, sep="\t")
+        return
+    with openProduct(path) as handle:
+        header = csv.reader(handle, delimiter="\t").next()
+    names = uniqueNames(header[1:])
+    for start in range(0, max(1, len(names)), group_size):
+        end = min(start + group_size, len(names))
+        chunk = pd.read_csv(path, sep="\t", header=None, skiprows=1, usecols=[0] + range(start + 1, end + 1), dtype={ 0 : object })
+        chunk = chunk.set_index(0)
+        chunk.columns = names[start:end]
+        chunk.index.name = header[0] if header[0] != "" else None
+        yield chunk
+
+def writeParquet( binPath, chunks ):
+    import pyarrow
+    import pyarrow.parquet
+    writer = None
+    try:
+        for chunk in chunks:
+            table = pyarrow.Table.from_pandas(chunk)
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(binPath, table.schema, compression="snappy")
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+def writeBinary( path, binPath, fileType, format ):
+    """
+    Write a typed, compressed copy of the TSV product at path to binPath. HDF5 is
+    written in fixed format, a table's column list has to fit in a 64KB HDF5
+    attribute, so wide matrices are stored as nodes data0, data1, ... of up to
+    HDF5_GROUP_COLUMNS columns, and the columns node maps each column to its
+    node. Parquet is written with pyarrow as one row group per block of rows.
+    """
+    if os.path.exists(binPath):
+        os.unlink(binPath)
+    if format == "hdf5":
+        store = pd.HDFStore(binPath, mode="w", complib="zlib", complevel=5)
+        try:
+            names = []
+            groups = []
+            for i, chunk in enumerate(readColumnGroups(path, fileType)):
+                store.put("data%d" % (i), chunk, format="fixed")
+                names += list(chunk.columns)
+                groups += [i] * chunk.shape[1]
+            store.put("columns", pd.Series(groups, index=names, dtype=np.int64), format="fixed")
+        finally:
+            store.close()
+    elif format == "parquet":
+        try:
+            writeParquet(binPath, readBinaryChunks(path, fileType))
+        except ValueError:
+            #matrix values that aren't all numbers, typed by read_csv from the whole file instead
+            if os.path.exists(binPath):
+                os.unlink(binPath)
+            writeParquet(binPath, readBinaryChunks(path, fileType, chunk_size=None))
+    else:
+        raise Exception("Unknown binary format %s" % (format))
+
+def selectColumns( names, columns ):
+    """The names wanted by columns, a list of names or a function saying whether a name is wanted"""
+    if callable(columns):
+        return [ name for name in names if columns(name) ]
+    columns = set(columns)
+    return [ name for name in names if name in columns ]
+
+def readHDF5( path, columns=None ):
+    """Frame from a writeBinary HDF5 file, only reading the nodes that hold the wanted columns"""
+    store = pd.HDFStore(path, mode="r")
+    try:
+        groups = store["columns"]
+        if columns is not None:
+            groups = groups[selectColumns(groups.index, columns)]
+        keys = sorted(set(groups.values.tolist())) or [0]
+        frames = [ store["data%d" % (k)] for k in keys ]
+    finally:
+        store.close()
+    df = frames[0] if len(frames) == 1 else pd.concat(frames, axis=1)
+    if columns is not None:
+        df = df[list(groups.index)]
+    return df
+
+def readParquet( path, columns=None ):
+    """Frame from a writeBinary Parquet file, only reading the wanted columns"""
+    import pyarrow.parquet
+    if columns is not None:
+        schema = pyarrow.parquet.ParquetFile(path).schema.to_arrow_schema()
+        index = json.loads(schema.metadata["pandas"])["index_columns"]
+        columns = selectColumns([ name for name in schema.names if name not in index ], columns)
+    return pyarrow.parquet.read_table(path, columns=columns, use_pandas_metadata=True).to_pandas()
+
+def readBinary( path, format, columns=None, na_values=None, **kwargs ):
+    """
+    Frame from the binary copy at path. Of the read_csv options only na_values
+    applies: the cells it lists become missing and the columns they kept from
+    being numbers are converted, as read_csv would have typed them.
+    """
+    if len(kwargs):
+        raise TypeError("Can't read the %s copy with %s" % (format, ", ".join(sorted(kwargs))))
+    if format == "hdf5":
+        df = readHDF5(path, columns)
+    else:
+        df = readParquet(path, columns)
+    if na_values is not None:
+        if isinstance(na_values, basestring):
+            na_values = [na_values]
+        na_values = list(na_values)
+        for name in df.columns:
+            if df[name].dtype == object:
+                values = df[name].where(~df[name].isin(na_values))
+                df[name] = pd.to_numeric(values, errors="ignore")
+    return df
+
+def openProduct( path ):
+    if path.endswith(".gz"):
+        return gzip.open(path)
+    return open(path)
+
+def readProduct( path, columns=None, fileType=None, **kwargs ):
+    """
+    Load a build product, from its binary copy when the .json sidecar names one
+    and its module is installed, reading only the wanted columns, otherwise from
+    the TSV. columns is a list of names or a function saying whether a name is
+    wanted. fileType is for files without a sidecar, a seg has no row labels.
+    kwargs go to read_csv when the TSV is read, the binary copy only takes na_values
+    """
+    meta = {}
+    if os.path.exists(path + ".json"):
+        with open(path + ".json") as handle:
+            meta = json.load(handle)
+        fileType = meta["annotations"].get("fileType")
+    binary = meta.get("binary")
+    if binary is not None and binaryAvailable(binary["format"]):
+        return readBinary(os.path.join(os.path.dirname(path), binary["file"]), binary["format"], columns, **kwargs)
+    index_col = None if fileType == "seg" else 0
+    if columns is None:
+        return pd.read_csv(path, sep="\t", index_col=index_col, **kwargs)
+    with openProduct(path) as handle:
+        header = csv.reader(handle, delimiter="\t").next()
+    names = uniqueNames(header)
+    wanted = set(selectColumns(names, columns))
+    usecols = [ i for i in range(len(names)) if names[i] in wanted ]
+    if index_col is not None:
+        usecols = [0] + [ i for i in usecols if i != 0 ]
+    return pd.read_csv(path, sep="\t", index_col=index_col, usecols=usecols, **kwargs)
+
+def entityAnnotation( entity, key ):
+    """A Synapse annotation of entity, which the client hands back as a list"""
+    value = entity.annotations.get(key)
+    if isinstance(value, list):
+        return value[0] if len(value) else None
+    return value
+
+def readSynapseProduct( syn, entity, columns=None, fileType=None, **kwargs ):
+    """
+    readProduct for a product stored in Synapse, entity as returned by syn.get,
+    with or without its file. synapseLoad_files uploads the binary copy into
+    the same folder and names it in the binaryFile and binaryFormat annotations,
+    it is downloaded and read instead of the TSV when its module is installed
+    """
+    binFile = entityAnnotation(entity, "binaryFile")
+    format = entityAnnotation(entity, "binaryFormat")
+    if binFile is not None and format in BINARY_FORMATS and binaryAvailable(format):
+        binId = syn._findEntityIdByNameAndParent(binFile, entity.parentId)
+        if binId is not None:
+            return readBinary(syn.get(binId).path, format, columns, **kwargs)
+    return readProduct(syn.get(entity).path, columns=columns, fileType=fileType, **kwargs)
+
+def readManifest( path ):
+    """File name to md5, from an archive's MANIFEST.txt, empty if there is none"""
+    out = {}
+    if not os.path.exists(path):
+        return out
+    with open(path) as handle:
+        for line in handle:
+            tmp = line.rstrip("\r\n").split(None, 1)
+            if len(tmp) == 2:
+                out[tmp[1]] = tmp[0].lower()
+    return out
+
+def walkFiles( path ):
+    """Files under path, in the order a recursive glob of '*' lists them (hidden files skipped)"""
+    if not os.path.isdir(path):
+        yield path
+        return
+    for name in os.listdir(path):
+        if not name.startswith("."):
+            for file in walkFiles(os.path.join(path, name)):
+                yield file
+
+def treeSize( path ):
+    """Bytes used by the files under path, a file hard linked in several places counts once"""
+    size = 0
+    seen = set()
+    for dir, dirs, files in os.walk(path):
+        for name in files:
+            st = os.lstat(os.path.join(dir, name))
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add( (st.st_dev, st.st_ino) )
+                size += st.st_size
+    return size
+
+def readMD5File( path ):
+    """Digest from a DCC style .md5 file, None if there isn't one"""
+    if not os.path.exists( path ):
+        return None
+    handle = open( path )
+    line = handle.readline()
+    handle.close()
+    return line.split(' ')[0]
+
+def findDecoder( names=("pigz", "unpigz") ):
+    """Path to a parallel gzip decoder, None if none is installed"""
+    for name in names:
+        path = find_executable(name)
+        if path is not None:
+            return path
+    return None
+
+def tarCommand( path, dest, decoder=None ):
+    """tar command line to extract the tar.gz at path (- for stdin) into dest"""
+    if decoder is None:
+        return [ "tar", "xzf", path, "-C", dest ]
+    return [ "tar", "-x", "--use-compress-program", decoder, "-f", path, "-C", dest ]
+
+def extractTar( path, dest, chunk_size=1024*1024, decoder=None ):
+    """
+    Extract the tar.gz at path into dest, returns the md5 of the compressed
+    file, computed from the same read that feeds tar
+    """
+    md5 = hashlib.md5()
+    proc = subprocess.Popen(tarCommand("-", dest, decoder), stdin=subprocess.PIPE)
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), ''):
+                md5.update(chunk)
+                proc.stdin.write(chunk)
+        proc.stdin.close()
+    except IOError:
+        #tar quit early, its exit status says why
+        pass
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, "tar xzf %s" % (path))
+    return md5.hexdigest()
+
+def mergeTree( src, dst ):
+    """Move everything under src into dst, merging directories that are already there, then remove src"""
+    for name in os.listdir(src):
+        s = os.path.join(src, name)
+        d = os.path.join(dst, name)
+        try:
+            os.rename(s, d)
+        except OSError:
+            #another archive has the same directory
+            if not (os.path.isdir(s) and os.path.isdir(d)):
+                raise
+            mergeTree(s, d)
+    os.rmdir(src)
+
+
+class DigestReader(object):
+    """File like wrapper that md5s everything read through it"""
+    def __init__(self, handle):
+        self.handle = handle
+        self.md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self.handle.read(size)
+        self.md5.update(data)
+        return data
+
+    def hexdigest(self, chunk_size=1024*1024):
+        #tar stops reading at the end of archive marker, the rest of the file still counts
+        for chunk in iter(lambda: self.read(chunk_size), ''):
+            pass
+        return self.md5.hexdigest()
+
+
+class DigestWriter(object):
+    """File like wrapper that md5s and counts everything written through it"""
+    def __init__(self, handle):
+        self.handle = handle
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def write(self, data):
+        self.md5.update(data)
+        self.size += len(data)
+        self.handle.write(data)
+
+    def flush(self):
+        self.handle.flush()
+
+    def close(self):
+        self.handle.close()
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+
+class ProductWriter(object):
+    """
+    Writes a file into the output directory in place: to a temp file beside it
+    that commit renames over path, so a half written product is never seen
+    under its real name. The md5 and size of the bytes that land on disk are
+    taken as they are written, through gzip when compressing. bgzip runs as
+    its own process writing to the temp file, that is md5'd once it exits.
+    """
+    def __init__(self, path, compress=None, bgzip=None):
+        self.path = path
+        self.compress = compress
+        fd, self.tmpPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix="." + os.path.basename(path) + ".")
+        self.handle = DigestWriter(os.fdopen(fd, "wb"))
+        self.proc = None
+        self.linked = False
+        self.closed = False
+        self.rawSize = 0
+        if compress == "gzip":
+            #no name or timestamp in the header, so the same output always has the same md5
+            self.out = gzip.GzipFile(filename="", mode="wb", fileobj=self.handle, compresslevel=6, mtime=0)
+        elif compress == "bgzip":
+            self.proc = subprocess.Popen([bgzip, "-c"], stdin=subprocess.PIPE, stdout=self.handle.handle)
+            self.out = self.proc.stdin
+        else:
+            self.out = self.handle
+
+    def write(self, data):
+        self.rawSize += len(data)
+        self.out.write(data)
+
+    def linkFrom(self, path):
+        """Hard link path in as the product instead of writing it, False if it is on another filesystem"""
+        try:
+            os.link(path, self.tmpPath + ".link")
+        except OSError:
+            return False
+        self.handle.close()
+        os.rename(self.tmpPath + ".link", self.tmpPath)
+        self.linked = True
+        self.rawSize = os.path.getsize(self.tmpPath)
+        return True
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.linked:
+            self.md5 = fileDigest(self.tmpPath)
+            self.size = self.rawSize
+            return
+        if self.out is not self.handle:
+            self.out.close()
+        if self.proc is not None:
+            if self.proc.wait() != 0:
+                raise Exception("bgzip failed writing %s" % (self.path))
+            self.handle.close()
+            self.md5 = fileDigest(self.tmpPath)
+            self.size = os.path.getsize(self.tmpPath)
+        else:
+            self.handle.close()
+            self.md5 = self.handle.hexdigest()
+            self.size = self.handle.size
+
+    def commit(self):
+        self.close()
+        if not self.linked:
+            #mkstemp makes the file private, give it the mode open() would have
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(self.tmpPath, 0666 & ~umask)
+        os.rename(self.tmpPath, self.path)
+
+
+class GzipReader(object):
+    """
+    Uncompressed view of a .gz file that can seek. Every checkpoint_size
+    bytes of input a copy of the decompressor is kept in checkpoints, a list
+    that can be shared between readers of the same file, so a seek only
+    inflates from the nearest checkpoint instead of the start of the file.
+    zlib can't save its state to disk, so the checkpoints only last as long
+    as the process.
+    """
+    def __init__(self, path, checkpoints=None, chunk_size=1024*1024, checkpoint_size=8*1024*1024):
+        self.handle = open(path, "rb")
+        self.chunk_size = chunk_size
+        self.checkpoint_size = checkpoint_size
+        self.checkpoints = checkpoints if checkpoints is not None else []
+        if len(self.checkpoints) == 0:
+            self.checkpoints.append( (0, 0, zlib.decompressobj(16 + zlib.MAX_WBITS)) )
+        self.restore(self.checkpoints[0])
+
+    def restore(self, checkpoint):
+        offset, coffset, decomp = checkpoint
+        self.handle.seek(coffset)
+        self.decomp = decomp.copy()
+        #self.buf[self.bufpos:] is the data starting at self.pos
+        self.pos = offset
+        self.buf = ""
+        self.bufpos = 0
+        self.eof = False
+
+    def fill(self):
+        chunk = self.handle.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            data = self.decomp.flush()
+        else:
+            data = self.decomp.decompress(chunk)
+            #concatenated gzip members, anything but trailing padding starts a new one
+            while self.decomp.unused_data.strip("\0"):
+                rest = self.decomp.unused_data
+                self.decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                data += self.decomp.decompress(rest)
+        self.buf = self.buf[self.bufpos:] + data
+        self.bufpos = 0
+        end = self.pos + len(self.buf)
+        last = self.checkpoints[-1]
+        if chunk and self.handle.tell() - last[1] >= self.checkpoint_size and end > last[0]:
+            self.checkpoints.append( (end, self.handle.tell(), self.decomp.copy()) )
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset):
+        best = None
+        for checkpoint in self.checkpoints:
+            if checkpoint[0] <= offset:
+                best = checkpoint
+        if offset < self.pos or best[0] > self.pos + len(self.buf) - self.bufpos:
+            self.restore(best)
+        while self.pos + len(self.buf) - self.bufpos < offset and not self.eof:
+            self.pos += len(self.buf) - self.bufpos
+            self.buf = ""
+            self.bufpos = 0
+            self.fill()
+        skip = min(offset - self.pos, len(self.buf) - self.bufpos)
+        self.bufpos += skip
+        self.pos += skip
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buf) - self.bufpos < size) and not self.eof:
+            self.fill()
+        if size < 0:
+            size = len(self.buf) - self.bufpos
+        data = self.buf[self.bufpos:self.bufpos + size]
+        self.bufpos += len(data)
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.handle.close()
+
+
+class TarIndex(object):
+    """
+    Member list of a tar.gz, with the offset and size of each member's data
+    in the uncompressed stream. Kept beside the tarball as <tarball>.idx and
+    trusted while the tarball's size, mtime and inode are unchanged.
+    """
+    def __init__(self, path, members):
+        self.path = path
+        self.members = members
+
+    @staticmethod
+    def stamp(path):
+        st = os.stat(path)
+        return [ st.st_size, repr(st.st_mtime), st.st_ino ]
+
+    @staticmethod
+    def load(path, checkpoints=None):
+        """Index for the tarball at path, built (and saved if the mirror is writable) when missing or stale"""
+        try:
+            handle = open(path + ".idx")
+            data = json.loads(handle.read())
+            handle.close()
+            if data['stamp'] == TarIndex.stamp(path):
+                return TarIndex(path, [ (m[0].encode('utf-8'), m[1], m[2]) for m in data['members'] ])
+        except (IOError, ValueError, KeyError):
+            pass
+        index = TarIndex.build(path, checkpoints)
+        index.save()
+        return index
+
+    @staticmethod
+    def build(path, checkpoints=None):
+        reader = GzipReader(path, checkpoints)
+        members = []
+        try:
+            tar = tarfile.open(fileobj=reader, mode="r|")
+            for info in tar:
+                if info.isfile():
+                    members.append( (info.name, info.offset_data, info.size) )
+            tar.close()
+        finally:
+            reader.close()
+        return TarIndex(path, members)
+
+    def save(self):
+        tmp = "%s.idx.%d" % (self.path, os.getpid())
+        try:
+            handle = open(tmp, "w")
+            handle.write(json.dumps({ 'stamp' : TarIndex.stamp(self.path), 'members' : self.members }))
+            handle.close()
+            os.rename(tmp, self.path + ".idx")
+        except (IOError, OSError):
+            #a read only mirror just means indexing again next time
+            pass
+
+    def find(self, name):
+        for member in self.members:
+            if member[0] == name:
+                return member
+        return None
+
+    def read(self, name, reader):
+        """Data of the named member, read through the GzipReader on the tarball"""
+        member = self.find(name)
+        if member is None:
+            raise KeyError(name)
+        reader.seek(member[1])
+        return reader.read(member[2])
+
+
+class ChecksumIndex(object):
+    """
+    Sidecar index of archive md5s for a mirror, stored in <mirror>/.md5index.
+    A digest is keyed by path, size, mtime and inode, so it is only trusted
+    while the file is unchanged. Lines are only ever appended, the last
+    line for a path wins, which keeps concurrent jobs from clobbering
+    each other. Once superseded lines are more than half of the file it
+    is rewritten with one line per path.
+    """
+    def __init__(self, mirror):
+        self.mirror = os.path.abspath(mirror)
+        self.path = os.path.join(self.mirror, ".md5index")
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        self.entries = {}
+        self.lines = 0
+        if os.path.exists(self.path):
+            handle = open(self.path)
+            for line in handle:
+                tmp = line.rstrip("\n").split("\t")
+                if len(tmp) == 5:
+                    self.entries[tmp[0]] = (tmp[1], tmp[2], tmp[3], tmp[4])
+                    self.lines += 1
+            handle.close()
+
+    def key(self, path):
+        st = os.stat(path)
+        return os.path.relpath(os.path.abspath(path), self.mirror), (str(st.st_size), repr(st.st_mtime), str(st.st_ino))
+
+    def lookup(self, path):
+        """The recorded md5 for path, or None if it is missing or the file changed"""
+        name, stamp = self.key(path)
+        entry = self.entries.get(name, None)
+        if entry is not None and entry[:3] == stamp:
+            return entry[3]
+        return None
+
+    def record(self, path, md5):
+        name, stamp = self.key(path)
+        with self.lock:
+            if self.entries.get(name, None) == stamp + (md5,):
+                return
+            self.entries[name] = stamp + (md5,)
+            handle = open(self.path, "a")
+            handle.write("\t".join( (name,) + stamp + (md5,) ) + "\n")
+            handle.close()
+            self.lines += 1
+            if self.lines > 2 * len(self.entries):
+                self.compact()
+
+    def compact(self):
+        #pick up what other jobs appended since the index was loaded
+        self.load()
+        out = ProductWriter(self.path)
+        for name in sorted(self.entries):
+            out.write("\t".join( (name,) + self.entries[name] ) + "\n")
+        out.commit()
+        self.lines = len(self.entries)
+
+    def digest(self, path):
+        """md5 of path, only read from disk if it changed since it was last recorded"""
+        md5 = self.lookup(path)
+        if md5 is None:
+            md5 = fileDigest(path)
+            self.record(path, md5)
+        return md5
+
 
 def platform_list():
     #q = CustomQuery("Platform")
@@ -1519,6 +4054,36 @@ def mutation_archive_list():
                 out[name] = True        
     return out.keys()
 
+def addQueryOptions(parser):
+    parser.add_argument("--query-cache", dest="query_cache", help="Directory to cache DCC query pages in", default=None)
+    parser.add_argument("--query-cache-ttl", dest="query_cache_ttl", type=float, help="Hours before a cached query page is fetched again", default=24)
+    parser.add_argument("--query-cache-size", dest="query_cache_size", type=int, help="Query cache size limit (MB)", default=1024)
+    parser.add_argument("--offline", dest="offline", action="store_true", help="Answer queries from the query cache only", default=False)
+    parser.add_argument("--query-parser", dest="query_parser", choices=["stream", "dom"], help="DCC query page parser", default="stream")
+    parser.add_argument("--query-threads", dest="query_threads", type=int, help="Concurrent DCC queries", default=8)
+    parser.add_argument("--dcc-server", dest="dcc_server", help="Base URL of a stand in DCC server (dccwsServer.py)", default=None)
+    parser.add_argument("--catalog", dest="catalog", help="Answer queries from a catalog database made with 'catalog sync'", default=None)
+
+def setupQueryOptions(options):
+    global dccServer
+    dccServer = options.dcc_server
+    dccwsItem.parser = options.query_parser
+    dccwsItem.engine.setMaxActive(options.query_threads)
+    if options.offline and options.query_cache is None:
+        sys.stderr.write("--offline needs a --query-cache directory\n")
+        sys.exit(1)
+    if options.query_cache is not None:
+        dccwsItem.cache = QueryCache(options.query_cache,
+            ttl=options.query_cache_ttl * 3600,
+            max_size=options.query_cache_size * 1024 * 1024,
+            offline=options.offline)
+    if options.catalog is not None:
+        if not os.path.exists(options.catalog):
+            sys.stderr.write("Catalog %s not found, run 'catalog sync' first\n" % (options.catalog))
+            sys.exit(1)
+        dccwsItem.catalog = DCCCatalog(options.catalog)
+
+
 def main_list(options):
     #################
     #list operations
@@ -1645,8 +4210,111 @@ def get_basename_platform(basename):
     return basename_platform_alias
 
 
+def main_catalog(options):
+    if options.catalog_action == "sync":
+        #always sync from the DCC, never from an older catalog
+        dccwsItem.catalog = None
+        DCCCatalog.sync(options.db)
+    return 0
+
+
+def verifyArchive(args):
+    """Worker for main_verify_mirror, returns the md5 for path unless the index already had it"""
+    path, md5 = args
+    if md5 is None:
+        md5 = fileDigest(path)
+    return path, md5
+
+def main_verify_mirror(options):
+    md5index = ChecksumIndex(options.mirror)
+    #interleave the archives by device, so the workers spread over the disks
+    byDevice = {}
+    for root, dirs, files in os.walk(options.mirror):
+        for name in sorted(files):
+            if name.endswith(".tar.gz"):
+                path = os.path.join(root, name)
+                byDevice.setdefault(os.stat(path).st_dev, []).append(path)
+    queues = byDevice.values()
+    paths = []
+    while any(queues):
+        for q in queues:
+            if len(q):
+                paths.append(q.pop(0))
+
+    pool = Pool(options.jobs)
+    counts = {}
+    try:
+        for path, md5 in pool.imap_unordered(verifyArchive, [ (p, md5index.lookup(p)) for p in paths ]):
+            md5index.record(path, md5)
+            omd5 = readMD5File(path + ".md5")
+            if omd5 is None:
+                status = "MD5_NOT_FOUND"
+            elif omd5 != md5:
+                status = "CORRUPT"
+                if options.delete:
+                    #the lock builds and downloads take, and only if no build replaced it since it was hashed
+                    with FileLock(path + ".lock"):
+                        if os.path.exists(path) and md5index.lookup(path) == md5:
+                            os.unlink(path)
+                            os.unlink(path + ".md5")
+            else:
+                status = "OK"
+            counts[status] = counts.get(status, 0) + 1
+            if status != "OK" or options.all:
+                print json.dumps( { "status" : status, "path" : path, "md5" : md5, "expected" : omd5 } )
+                sys.stdout.flush()
+    finally:
+        pool.terminate()
+        pool.join()
+    sys.stderr.write("%s\n" % (", ".join( "%s: %d" % (k, counts[k]) for k in sorted(counts) )))
+    return 1 if "CORRUPT" in counts else 0
+
+
+def main_dedupe_mirror(options):
+    md5index = ChecksumIndex(options.mirror)
+    store = ContentStore(options.mirror, md5index)
+    saved = 0
+    for root, dirs, files in os.walk(options.mirror):
+        if os.path.abspath(root).startswith(os.path.abspath(store.path)):
+            continue
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if name.endswith(".tar.gz") and not os.path.islink(path):
+                md5 = md5index.digest(path)
+                obj = store.objectPath(md5)
+                if os.path.exists(obj) and not os.path.samefile(obj, path):
+                    saved += os.stat(path).st_size
+                    print "DUPLICATE:", path
+                store.add(path, md5)
+    sys.stderr.write("%0.2fMb freed\n" % (saved / 1024.**2))
+    return 0
+
+
+def main_tar_member(options):
+    index = TarIndex.load(options.tarball)
+    if len(options.members) == 0:
+        for name, offset, size in index.members:
+            print "%s\t%d\t%d" % (name, offset, size)
+        return 0
+    reader = GzipReader(options.tarball)
+    try:
+        for name in options.members:
+            try:
+                sys.stdout.write(index.read(name, reader))
+            except KeyError:
+                sys.stderr.write("Not in archive: %s\n" % (name))
+                return 1
+    finally:
+        reader.close()
+    return 0
+
+
 def main_build(options):
 
+    if options.incremental is not None and options.stream:
+        sys.stderr.write("--incremental can't be used with --stream, streamed files aren't parsed one at a time\n")
+        return 1
+
     #if archive name is provided, determine the platform
     basename_platform_alias = None
     if options.basename:
@@ -1658,38 +4326,6 @@ def main_build(options):
     ###################
 
     if basename_platform_alias is not None:
-        if options.checksum or options.checksum_delete:
-            urls = []
-            q = tcgaConfig[basename_platform_alias].getArchiveUrls(options.basename)
-            for e in q:
-                urls.append( e )
-            mage_url = tcgaConfig[basename_platform_alias].getMageUrl(options.basename)
-            if mage_url:
-                urls.append(mage_url)
-            
-            for url in urls:
-                dst = os.path.join(options.mirror, re.sub("^/", "", url))
-                if not os.path.exists( dst ):
-                    print "NOT_FOUND:", dst
-                    continue
-                if not os.path.exists( dst + ".md5" ):
-                    print "MD5_NOT_FOUND", dst
-                    continue
-
-                handle = open( dst + ".md5" )
-                line = handle.readline()
-                omd5 = line.split(' ')[0]
-                handle.close()
-
-                nmd5 = fileDigest( dst )
-                if omd5 != nmd5:
-                    print "CORRUPT:", dst
-                    if options.checksum_delete:
-                        os.unlink(dst)
-                        os.unlink(dst + ".md5")
-                else:
-                    print "OK:", dst        
-
         if options.mirror is None:
             sys.stderr.write("Need mirror location\n")
             return 1
@@ -1717,6 +4353,7 @@ if __name__ == "__main__":
 
     parser = ArgumentParser()
     #Stack.addJobTreeOptions(parser) 
+    addQueryOptions(parser)
 
     subparsers = parser.add_subparsers(title="subcommand")
 
@@ -1766,6 +4403,29 @@ if __name__ == "__main__":
     """
     parser_download.set_defaults(func=main_download)
 
+    parser_catalog = subparsers.add_parser('catalog')
+    parser_catalog.add_argument("catalog_action", choices=[
+        "sync"
+    ])
+    parser_catalog.add_argument("db", help="Catalog database path")
+    parser_catalog.set_defaults(func=main_catalog)
+
+    parser_verify = subparsers.add_parser('verify-mirror')
+    parser_verify.add_argument("mirror", help="Mirror Location")
+    parser_verify.add_argument("-j", "--jobs", type=int, help="Archives to check at once", default=cpu_count())
+    parser_verify.add_argument("--delete", action="store_true", help="Delete corrupt archives", default=False)
+    parser_verify.add_argument("--all", action="store_true", help="Report OK archives too", default=False)
+    parser_verify.set_defaults(func=main_verify_mirror)
+
+    parser_dedupe = subparsers.add_parser('dedupe-mirror')
+    parser_dedupe.add_argument("mirror", help="Mirror Location")
+    parser_dedupe.set_defaults(func=main_dedupe_mirror)
+
+    parser_member = subparsers.add_parser('tar-member')
+    parser_member.add_argument("tarball", help="Mirrored tar.gz, indexed on first use")
+    parser_member.add_argument("members", nargs="*", help="Members to write to stdout, lists the index if none are given")
+    parser_member.set_defaults(func=main_tar_member)
+
     #archive importers
     parser_build = subparsers.add_parser('build')
 
@@ -1778,9 +4438,21 @@ if __name__ == "__main__":
     parser_build.add_argument("-m", "--mirror", dest="mirror", help="Mirror Location", default=None)
     parser_build.add_argument("-w", "--workdir", dest="workdir_base", help="Working directory", default="/tmp")
     parser_build.add_argument("-d", "--download", dest="download", help="Download files for archive", action="store_true", default=False)
+    parser_build.add_argument("--download-jobs", dest="download_jobs", type=int, help="Archives to download at once", default=4)
+    parser_build.add_argument("--cas", dest="cas", help="Keep downloaded archives in the mirror's content addressed store", action="store_true", default=False)
     parser_build.add_argument("-e", "--level", dest="level", help="Data Level ", default="3")
     parser_build.add_argument("--checksum", dest="checksum", help="Check project md5", action="store_true", default=False)
     parser_build.add_argument("--checksum-delete", dest="checksum_delete", help="Check project md5 and delete bad files", action="store_true", default=False)
+    parser_build.add_argument("-j", "--jobs", dest="jobs", type=int, help="Processes to parse sample files and format output with", default=1)
+    parser_build.add_argument("--matrix-store", dest="matrix_store", choices=["float32", "float64"], help="Assemble matrices out of core, in a column store of this type in the workdir", default=None)
+    parser_build.add_argument("--extract-jobs", dest="extract_jobs", type=int, help="Archives to extract at once", default=cpu_count())
+    parser_build.add_argument("--pigz", dest="pigz", help="Decompress with pigz when it is installed", action="store_true", default=False)
+    parser_build.add_argument("--extract-cache", dest="extract_cache", help="Directory to keep extracted archives in between builds", default=None)
+    parser_build.add_argument("--extract-cache-size", dest="extract_cache_size", type=int, help="Extract cache size limit (MB)", default=102400)
+    parser_build.add_argument("--incremental", dest="incremental", help="Keep per file parse results here, and only parse files that are new or changed since the last build (not with --stream)", default=None)
+    parser_build.add_argument("--stream", dest="stream", help="Read files straight out of the archives instead of extracting them to the workdir", action="store_true", default=False)
+    parser_build.add_argument("--tar-index", dest="tar_index", help="With --stream, read only the members a build needs through a sidecar index of each archive", action="store_true", default=False)
+    parser_build.add_argument("--single-pass", dest="single_pass", help="Check md5s while extracting, reading each archive once", action="store_true", default=False)
     parser_build.add_argument("-r", "--sanitize", dest="sanitize", action="store_true", help="Remove race/ethnicity from clinical data", default=False)
     parser_build.add_argument("--rmControl", dest="rmControl", help="Remove Control Sample", action="store_true", default=False)    
 
@@ -1790,8 +4462,11 @@ if __name__ == "__main__":
     parser_build.add_argument("-o", "--out", dest="outpath", help="Output Dest", default=None)    
     parser_build.add_argument("--out-error", dest="errorpath", help="Output Error", default=None)
     parser_build.add_argument("--out-meta", dest="metapath", help="Output Meta", default=None)
+    parser_build.add_argument("--compress", dest="compress", choices=["gzip", "bgzip"], help="Write matrices, segments and clinical matrices compressed, as .gz", default=None)
+    parser_build.add_argument("--binary", dest="binary", choices=sorted(BINARY_FORMATS), help="Also write matrices, segments and clinical matrices in this typed binary format, named in the .json", default=None)
     parser_build.set_defaults(func=main_build)
 
 
     args = parser.parse_args()
+    setupQueryOptions(args)
     sys.exit(args.func(args))
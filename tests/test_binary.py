@@ -0,0 +1,155 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+from argparse import Namespace
+
+import numpy as np
+import pandas as pd
+from pandas.util.testing import assert_frame_equal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tcgaImport
+
+
+class BinaryTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def writeProduct(self, df, fileType, format=None, index=True):
+        path = os.path.join(self.dir, "product.tsv")
+        df.to_csv(path, sep="\t", index=index, float_format="%0.6g")
+        meta = { 'annotations' : { 'fileType' : fileType } }
+        if format is not None:
+            binPath = path + tcgaImport.BINARY_FORMATS[format][0]
+            tcgaImport.writeBinary(path, binPath, fileType, format)
+            meta['binary'] = { 'format' : format, 'file' : os.path.basename(binPath) }
+        handle = open(path + ".json", "w")
+        handle.write(json.dumps(meta))
+        handle.close()
+        return path
+
+    def wideMatrix(self):
+        rng = np.random.RandomState(1)
+        names = [ "TCGA-%02d-%04d-01A-11R-A00Z-07" % (i % 100, i) for i in range(2500) ]
+        df = pd.DataFrame(rng.uniform(size=(20, len(names))), columns=names,
+            index=[ "probe%d" % (i) for i in range(20) ])
+        df.iloc[3, 5] = np.nan
+        df.index.name = "sample"
+        return df
+
+    def check(self, format):
+        df = self.wideMatrix()
+        path = self.writeProduct(df, "genomicMatrix", format)
+        expected = pd.read_csv(path, sep="\t", index_col=0)
+        out = tcgaImport.readProduct(path)
+        assert_frame_equal(out, expected, check_index_type=False)
+        wanted = [ df.columns[2], df.columns[1700] ]
+        out = tcgaImport.readProduct(path, columns=wanted)
+        self.assertEqual(sorted(out.columns), sorted(wanted))
+        assert_frame_equal(out[wanted], expected[wanted], check_index_type=False)
+
+    @unittest.skipUnless(tcgaImport.binaryAvailable("hdf5"), "tables not installed")
+    def test_hdf5_wide(self):
+        self.check("hdf5")
+
+    @unittest.skipUnless(tcgaImport.binaryAvailable("parquet"), "pyarrow not installed")
+    def test_parquet_wide(self):
+        self.check("parquet")
+
+    def checkTyped(self, format):
+        #an integer column and a cell that isn't a number
+        df = pd.DataFrame({ "a" : [1.5, 2.5, 3.0], "b" : [10**9, 2, 3], "c" : ["0.5", "null", "2"] },
+            columns=["a", "b", "c"], index=["p1", "p2", "p3"])
+        path = self.writeProduct(df, "genomicMatrix", format)
+        out = tcgaImport.readProduct(path)
+        self.assertEqual(list(out["b"]), [10**9, 2, 3])
+        self.assertEqual(list(out["c"]), ["0.5", "null", "2"])
+        #na_values works on the binary copy as it does on the TSV
+        assert_frame_equal(tcgaImport.readProduct(path, na_values=["null"]),
+            pd.read_csv(path, sep="\t", index_col=0, na_values=["null"]), check_index_type=False)
+        self.assertRaises(TypeError, tcgaImport.readProduct, path, dtype=str)
+
+    @unittest.skipUnless(tcgaImport.binaryAvailable("hdf5"), "tables not installed")
+    def test_hdf5_types(self):
+        self.checkTyped("hdf5")
+
+    @unittest.skipUnless(tcgaImport.binaryAvailable("parquet"), "pyarrow not installed")
+    def test_parquet_types(self):
+        self.checkTyped("parquet")
+
+    @unittest.skipUnless(tcgaImport.binaryAvailable("hdf5"), "tables not installed")
+    def test_hdf5_seg(self):
+        df = pd.DataFrame({ "sample" : ["s1", "s1", "s2"], "chr" : ["1", "2", "X"], "start" : [1, 5, 9], "value" : [0.5, np.nan, -1.25] },
+            columns=["sample", "chr", "start", "value"])
+        path = self.writeProduct(df, "seg", "hdf5", index=False)
+        assert_frame_equal(tcgaImport.readProduct(path), pd.read_csv(path, sep="\t"))
+
+    def test_without_sidecar(self):
+        df = self.wideMatrix()
+        path = os.path.join(self.dir, "plain.tsv")
+        df.to_csv(path, sep="\t", float_format="%0.6g")
+        assert_frame_equal(tcgaImport.readProduct(path), pd.read_csv(path, sep="\t", index_col=0))
+        seg = pd.DataFrame({ "sample" : ["s1"], "value" : [0.5] })
+        seg.to_csv(path, sep="\t", index=False)
+        assert_frame_equal(tcgaImport.readProduct(path, fileType="seg"), seg)
+
+    def checkSelected(self, format):
+        df = self.wideMatrix()
+        path = self.writeProduct(df, "genomicMatrix", format)
+        expected = pd.read_csv(path, sep="\t", index_col=0)
+        wanted = lambda name: name.endswith("7-01A-11R-A00Z-07")
+        out = tcgaImport.readProduct(path, columns=wanted)
+        self.assertEqual(list(out.columns), [ name for name in df.columns if wanted(name) ])
+        assert_frame_equal(out, expected[list(out.columns)], check_index_type=False)
+        self.assertEqual(list(tcgaImport.readProduct(path, columns=[]).index), list(expected.index))
+
+    def test_tsv_selected(self):
+        self.checkSelected(None)
+
+    @unittest.skipUnless(tcgaImport.binaryAvailable("hdf5"), "tables not installed")
+    def test_hdf5_selected(self):
+        self.checkSelected("hdf5")
+
+    @unittest.skipUnless(tcgaImport.binaryAvailable("parquet"), "pyarrow not installed")
+    def test_parquet_selected(self):
+        self.checkSelected("parquet")
+
+    def checkSynapse(self, format):
+        path = self.writeProduct(self.wideMatrix(), "genomicMatrix", format)
+        #the product as syn.get hands it back, without the .json beside it
+        os.rename(path, os.path.join(self.dir, "product"))
+        entity = Namespace(id="syn1", parentId="syn0", path=os.path.join(self.dir, "product"), annotations={})
+        if format is not None:
+            entity.annotations = { 'binaryFile' : ["product.tsv" + tcgaImport.BINARY_FORMATS[format][0]], 'binaryFormat' : [format] }
+        class Synapse(object):
+            def _findEntityIdByNameAndParent(self, name, parentId):
+                return "syn2" if parentId == "syn0" and os.path.exists(os.path.join(dir, name)) else None
+            def get(self, id):
+                got.append(getattr(id, "id", id))
+                if id == "syn2":
+                    return Namespace(path=os.path.join(dir, entity.annotations['binaryFile'][0]))
+                return id
+        dir = self.dir
+        got = []
+        expected = pd.read_csv(entity.path, sep="\t", index_col=0)
+        wanted = list(expected.columns[:3])
+        out = tcgaImport.readSynapseProduct(Synapse(), entity, columns=wanted)
+        assert_frame_equal(out, expected[wanted], check_index_type=False)
+        return got
+
+    def test_synapse_tsv(self):
+        self.assertEqual(self.checkSynapse(None), ["syn1"])
+
+    @unittest.skipUnless(tcgaImport.binaryAvailable("hdf5"), "tables not installed")
+    def test_synapse_hdf5(self):
+        self.assertEqual(self.checkSynapse("hdf5"), ["syn2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
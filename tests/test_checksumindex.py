@@ -0,0 +1,62 @@
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import unittest
+from argparse import Namespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tcgaImport
+
+
+class ChecksumIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def writeFile(self, name, data):
+        path = os.path.join(self.dir, name)
+        handle = open(path, "wb")
+        handle.write(data)
+        handle.close()
+        return path
+
+    def test_digest(self):
+        index = tcgaImport.ChecksumIndex(self.dir)
+        path = self.writeFile("a.tar.gz", "aaa")
+        self.assertEqual(index.digest(path), hashlib.md5("aaa").hexdigest())
+        self.assertEqual(tcgaImport.ChecksumIndex(self.dir).lookup(path), hashlib.md5("aaa").hexdigest())
+        path = self.writeFile("a.tar.gz", "bbbb")
+        self.assertEqual(tcgaImport.ChecksumIndex(self.dir).lookup(path), None)
+
+    def test_compact(self):
+        index = tcgaImport.ChecksumIndex(self.dir)
+        paths = [ self.writeFile("%d.tar.gz" % (i), "x") for i in range(4) ]
+        for path in paths:
+            index.digest(path)
+        for i in range(20):
+            index.record(paths[0], "%032x" % (i))
+        lines = open(index.path).read().splitlines()
+        self.assertTrue(len(lines) <= 2 * len(paths))
+        #the last line for a path still wins
+        self.assertEqual(tcgaImport.ChecksumIndex(self.dir).lookup(paths[0]), "%032x" % (19))
+        self.assertEqual(tcgaImport.ChecksumIndex(self.dir).lookup(paths[3]), hashlib.md5("x").hexdigest())
+
+    def test_verify_mirror_delete(self):
+        good = self.writeFile("good.tar.gz", "good")
+        self.writeFile("good.tar.gz.md5", "%s  good.tar.gz\n" % (hashlib.md5("good").hexdigest()))
+        bad = self.writeFile("bad.tar.gz", "bad")
+        self.writeFile("bad.tar.gz.md5", "%s  bad.tar.gz\n" % (hashlib.md5("other").hexdigest()))
+        options = Namespace(mirror=self.dir, jobs=2, delete=True, all=False)
+        self.assertEqual(tcgaImport.main_verify_mirror(options), 1)
+        self.assertTrue(os.path.exists(good))
+        self.assertFalse(os.path.exists(bad))
+        self.assertFalse(os.path.exists(bad + ".md5"))
+        self.assertFalse(os.path.exists(bad + ".lock"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import unittest
+from argparse import Namespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tcgaImport
+
+
+class ContentStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.index = tcgaImport.ChecksumIndex(self.dir)
+        self.store = tcgaImport.ContentStore(self.dir, self.index)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def writeFile(self, name, data):
+        path = os.path.join(self.dir, name)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        handle = open(path, "wb")
+        handle.write(data)
+        handle.close()
+        return path
+
+    def test_add_dedupes(self):
+        md5 = hashlib.md5("same").hexdigest()
+        a = self.writeFile("x/a.Level_3.1.4.0.tar.gz", "same")
+        b = self.writeFile("x/a.Level_3.1.5.0.tar.gz", "same")
+        self.assertFalse(self.store.has(md5))
+        self.assertTrue(self.store.add(a, md5))
+        self.assertTrue(self.store.has(md5))
+        self.assertFalse(self.store.add(b, md5))
+        self.assertTrue(os.path.samefile(a, b))
+        self.assertTrue(os.path.samefile(b, self.store.objectPath(md5)))
+        self.assertEqual(open(b, "rb").read(), "same")
+
+    def test_corrupt_object(self):
+        md5 = hashlib.md5("same").hexdigest()
+        self.store.add(self.writeFile("a.tar.gz", "same"), md5)
+        os.unlink(os.path.join(self.dir, "a.tar.gz"))
+        self.writeFile(self.store.objectPath(md5)[len(self.dir) + 1:], "changed")
+        self.assertFalse(self.store.has(md5))
+
+    def test_dedupe_mirror(self):
+        paths = [ self.writeFile("d/%d.tar.gz" % (i), "same") for i in range(3) ]
+        other = self.writeFile("d/other.tar.gz", "other")
+        self.assertEqual(tcgaImport.main_dedupe_mirror(Namespace(mirror=self.dir)), 0)
+        for path in paths[1:]:
+            self.assertTrue(os.path.samefile(paths[0], path))
+        self.assertFalse(os.path.samefile(paths[0], other))
+        self.assertTrue(self.store.has(hashlib.md5("other").hexdigest()))
+
+
+if __name__ == "__main__":
+    unittest.main()
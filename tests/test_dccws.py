@@ -0,0 +1,270 @@
+import os
+import sys
+import shutil
+import socket
+import httplib
+import hashlib
+import tarfile
+import StringIO
+import tempfile
+import threading
+import unittest
+from argparse import Namespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tcgaImport
+import dccwsServer
+
+QUERY = "http://tcga-data.nci.nih.gov/tcgadccws/GetXML?query=Archive"
+
+PAGE = """<?xml version="1.0" encoding="UTF-8"?>
+<httpQuery xmlns:xlink="http://www.w3.org/1999/xlink">
+<queryResponse>%s</queryResponse>
+%s
+</httpQuery>
+"""
+
+def makePage(ids, next=None):
+    records = "".join( '<class recordNumber="%d"><field name="id">%d</field></class>' % (i, i) for i in ids )
+    link = '<next xlink:href="%s"/>' % (next.replace("&", "&amp;")) if next else ""
+    return PAGE % (records, link)
+
+
+class DCCServerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.mirror = os.path.join(self.dir, "mirror")
+        os.makedirs(self.mirror)
+        pages = tcgaImport.QueryCache(os.path.join(self.dir, "pages"))
+        pages.put(QUERY, makePage([1, 2], QUERY + "&pageNumber=2"))
+        pages.put(QUERY + "&pageNumber=2", makePage([3]))
+        options = Namespace(pages=pages.path, mirror=self.mirror, latency=0,
+            bandwidth=0, error_rate=0, truncate_rate=0)
+        self.server = dccwsServer.DCCServer(("localhost", 0), options)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = "http://localhost:%d" % self.server.server_address[1]
+        self.saved = (tcgaImport.dccServer, tcgaImport.dccwsItem.engine)
+        tcgaImport.dccServer = self.url
+        tcgaImport.dccwsItem.engine = tcgaImport.QueryEngine(min_delay=0.01, max_delay=0.01)
+
+    def tearDown(self):
+        tcgaImport.dccServer, tcgaImport.dccwsItem.engine = self.saved
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def deadConnection(self):
+        conn = httplib.HTTPConnection(self.url[len("http://"):], timeout=5)
+        conn.connect()
+        conn.sock.shutdown(socket.SHUT_RDWR)
+        return conn
+
+    def test_pagination(self):
+        for parser in ["stream", "dom"]:
+            ids = [ r['id'] for r in tcgaImport.CustomQuery("Archive", parser=parser) ]
+            self.assertEqual(ids, ["1", "2", "3"])
+
+    def test_dropped_keepalive(self):
+        engine = tcgaImport.dccwsItem.engine
+        host = self.url[len("http://"):]
+        #every idle connection has been dropped, the retry must not pick up another one
+        engine.idle[("http", host)] = [ self.deadConnection() for i in range(3) ]
+        handle = engine.urlopen(self.url + "/tcgadccws/GetXML?query=Archive")
+        self.assertTrue("recordNumber" in handle.read())
+        handle.close()
+        ids = [ r['id'] for r in tcgaImport.CustomQuery("Archive") ]
+        self.assertEqual(ids, ["1", "2", "3"])
+
+    def test_retry_failure_closes(self):
+        engine = tcgaImport.dccwsItem.engine
+        host = self.url[len("http://"):]
+        engine.idle[("http", host)] = [ self.deadConnection() ]
+        opened = []
+        def newConnection(scheme, host):
+            conn = self.deadConnection()
+            opened.append(conn)
+            return conn
+        engine.newConnection = newConnection
+        self.assertRaises(Exception, engine.urlopen, self.url + "/tcgadccws/GetXML?query=Archive")
+        self.assertEqual(len(opened), 1)
+        self.assertEqual(opened[0].sock, None)
+
+    def fetch(self, path):
+        conn = httplib.HTTPConnection(self.url[len("http://"):], timeout=5)
+        conn.request("GET", path)
+        response = conn.getresponse()
+        data = response.read()
+        conn.close()
+        return response.status, data
+
+    def test_https_recorded_page(self):
+        pages = tcgaImport.QueryCache(self.server.options.pages)
+        pages.put(QUERY.replace("http://", "https://") + "[@id=7]", makePage([7]))
+        ids = [ r['id'] for r in tcgaImport.CustomQuery("Archive[@id=7]") ]
+        self.assertEqual(ids, ["7"])
+
+    def test_mirror_files(self):
+        handle = open(os.path.join(self.mirror, "a.tar.gz"), "wb")
+        handle.write("0123456789")
+        handle.close()
+        other = self.mirror + "-other"
+        os.makedirs(other)
+        handle = open(os.path.join(other, "secret"), "wb")
+        handle.write("secret")
+        handle.close()
+        self.assertEqual(self.fetch("/a.tar.gz"), (200, "0123456789"))
+        self.assertEqual(self.fetch("/../mirror-other/secret")[0], 404)
+        self.assertEqual(self.fetch("/%2e%2e/mirror-other/secret")[0], 404)
+        self.assertEqual(self.fetch("/")[0], 404)
+
+    def addArchive(self, name, data):
+        handle = open(os.path.join(self.mirror, name), "wb")
+        handle.write(data)
+        handle.close()
+        handle = open(os.path.join(self.mirror, name + ".md5"), "w")
+        handle.write("%s  %s\n" % (hashlib.md5(data).hexdigest(), name))
+        handle.close()
+        return "http://tcga-data.nci.nih.gov/" + name
+
+    def test_resume_download(self):
+        data = os.urandom(100000)
+        url = self.addArchive("a.tar.gz", data)
+        dst = os.path.join(self.dir, "a.tar.gz")
+        handle = open(dst + ".part", "wb")
+        handle.write(data[:30000])
+        handle.close()
+        downloader = tcgaImport.MirrorDownloader()
+        downloader.fetch(tcgaImport.dccURL(url), dst)
+        self.assertEqual(open(dst, "rb").read(), data)
+        self.assertFalse(os.path.exists(dst + ".part"))
+        self.assertEqual(downloader.digests[dst], hashlib.md5(data).hexdigest())
+
+    def buildConf(self, mirror):
+        conf = tcgaImport.BuildConf("platform", "name", 1, {}, [])
+        conf.mirror = mirror
+        conf.download = True
+        conf.download_jobs = 3
+        conf.checksum = False
+        conf.checksum_delete = True
+        conf.single_pass = False
+        conf.decoder = None
+        conf.md5index = tcgaImport.ChecksumIndex(mirror)
+        conf.downloader = tcgaImport.MirrorDownloader()
+        return conf
+
+    def test_checksum_refetch(self):
+        urls = [ self.addArchive("%s.tar.gz" % (n), os.urandom(5000)) for n in "abc" ]
+        local = os.path.join(self.dir, "local")
+        os.makedirs(local)
+        for n in "ab":
+            shutil.copy(os.path.join(self.mirror, n + ".tar.gz.md5"), local)
+        shutil.copy(os.path.join(self.mirror, "a.tar.gz"), local)
+        handle = open(os.path.join(local, "b.tar.gz"), "wb")
+        handle.write("corrupt")
+        handle.close()
+        conf = self.buildConf(local)
+        paths = conf.fetchArchives(urls)
+        self.assertEqual(paths, [ os.path.join(local, "%s.tar.gz" % (n)) for n in "abc" ])
+        for n in "abc":
+            self.assertEqual(open(os.path.join(local, n + ".tar.gz"), "rb").read(),
+                open(os.path.join(self.mirror, n + ".tar.gz"), "rb").read())
+
+    def test_cas_download(self):
+        data = os.urandom(5000)
+        urls = [ self.addArchive(name, data) for name in ["a.1.4.0.tar.gz", "a.1.5.0.tar.gz"] ]
+        local = os.path.join(self.dir, "local")
+        os.makedirs(local)
+        conf = self.buildConf(local)
+        conf.downloader.store = tcgaImport.ContentStore(local, conf.md5index)
+        first = conf.getURLPath(urls[0])
+        #the new revision has the same md5, it is linked to the stored copy rather than downloaded
+        conf.downloader.fetchPart = None
+        second = conf.getURLPath(urls[1])
+        self.assertTrue(os.path.samefile(first, second))
+        self.assertEqual(open(second, "rb").read(), data)
+        self.assertTrue(os.path.exists(second + ".md5"))
+
+    def tarData(self, files):
+        out = StringIO.StringIO()
+        tar = tarfile.open(fileobj=out, mode="w:gz")
+        for name, data in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, StringIO.StringIO(data))
+        tar.close()
+        return out.getvalue()
+
+    def test_single_pass_recovery(self):
+        tarData = self.tarData
+        url = self.addArchive("a.tar.gz", tarData([("a/data.txt", "good\n")]))
+        local = os.path.join(self.dir, "local")
+        os.makedirs(local)
+        shutil.copy(os.path.join(self.mirror, "a.tar.gz.md5"), local)
+        bad = tarData([("a/stale.txt", os.urandom(50000)), ("a/data.txt", "bad\n")])
+        handle = open(os.path.join(local, "a.tar.gz"), "wb")
+        handle.write(bad[:len(bad) / 2])
+        handle.close()
+
+        conf = self.buildConf(local)
+        conf.single_pass = True
+        conf.download = False
+        importer = tcgaImport.FileImporter(conf, {})
+        importer.work_dir = os.path.join(self.dir, "work")
+        os.makedirs(importer.work_dir)
+        path = os.path.join(local, "a.tar.gz")
+        try:
+            importer.extractArchive(url, path)
+            self.fail("Corrupt archive was extracted")
+        except Exception, e:
+            self.assertTrue("--download" in str(e))
+        self.assertFalse(os.path.exists(path))
+
+        shutil.copy(os.path.join(self.mirror, "a.tar.gz.md5"), local)
+        handle = open(path, "wb")
+        handle.write(bad[:len(bad) / 2])
+        handle.close()
+        conf.download = True
+        shutil.rmtree(importer.work_dir)
+        os.makedirs(importer.work_dir)
+        importer.extractArchive(url, path)
+        self.assertEqual(os.listdir(importer.work_dir), ["a"])
+        self.assertEqual(os.listdir(os.path.join(importer.work_dir, "a")), ["data.txt"])
+        self.assertEqual(open(os.path.join(importer.work_dir, "a", "data.txt")).read(), "good\n")
+
+    def test_single_pass_stream_recovery(self):
+        class Importer(tcgaImport.FileImporter):
+            dataSubTypes = { "a" : { 'fileInclude' : r'.*\.txt$' }, "b" : { 'fileInclude' : r'^data' } }
+            def mageScan(self, path):
+                scanned.append( (None, self.openFile(path).read()) )
+            def fileScan(self, path, dataSubType):
+                scanned.append( (dataSubType, self.openFile(path).read()) )
+        files = [("a/a.sdrf.txt", "sdrf\n"), ("a/data.txt", "good\n"), ("a/other.txt", "other\n")]
+        url = self.addArchive("a.tar.gz", self.tarData(files))
+        local = os.path.join(self.dir, "local")
+        os.makedirs(local)
+        shutil.copy(os.path.join(self.mirror, "a.tar.gz.md5"), local)
+        #the bad copy reads to the end, only its digest shows it is corrupt
+        handle = open(os.path.join(local, "a.tar.gz"), "wb")
+        handle.write(self.tarData([("a/a.sdrf.txt", "stale\n"), ("a/data.txt", "bad\n")]))
+        handle.close()
+
+        conf = self.buildConf(local)
+        conf.single_pass = True
+        conf.stream = True
+        conf.tar_index = False
+        importer = Importer(conf, {})
+        importer.work_dir = os.path.join(self.dir, "work")
+        os.makedirs(importer.work_dir)
+        importer.archive_urls = [url]
+        importer.archive_paths = [os.path.join(local, "a.tar.gz")]
+        scanned = []
+        states = importer.streamTars()
+        #each member is scanned once for every pass that wants it, from the good copy only
+        self.assertEqual(scanned, [(None, "sdrf\n"), ("a", "good\n"), ("b", "good\n"), ("a", "other\n")])
+        self.assertEqual(sorted(states.keys(), key=str), sorted([None, "a", "b"], key=str))
+
+
+if __name__ == "__main__":
+    unittest.main()
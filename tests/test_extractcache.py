@@ -0,0 +1,101 @@
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tcgaImport
+
+
+def writeTree(files):
+    def extract(dest):
+        for name, data in files:
+            path = os.path.join(dest, name)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            handle = open(path, "wb")
+            handle.write(data)
+            handle.close()
+    return extract
+
+
+class ExtractCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_tree_size_counts_links_once(self):
+        writeTree([("a/x", "x" * 100), ("a/y", "y" * 10)])(self.dir)
+        os.link(os.path.join(self.dir, "a", "x"), os.path.join(self.dir, "a", "x2"))
+        self.assertEqual(tcgaImport.treeSize(self.dir), 110)
+
+    def test_reuse(self):
+        cache = tcgaImport.ExtractCache(os.path.join(self.dir, "cache"))
+        entry = cache.acquire("%032x" % (1), writeTree([("a/x", "x")]))
+        cache.release()
+        entry2 = cache.acquire("%032x" % (1), None)
+        self.assertEqual(entry, entry2)
+        self.assertEqual(open(os.path.join(entry2, "a", "x")).read(), "x")
+        cache.release()
+
+    def test_contains(self):
+        cache = tcgaImport.ExtractCache(os.path.join(self.dir, "cache"))
+        entry = cache.acquire("%032x" % (1), writeTree([("a/x", "x")]))
+        os.symlink(cache.path, os.path.join(self.dir, "link"))
+        self.assertTrue(cache.contains(os.path.join(entry, "a", "x")))
+        self.assertTrue(cache.contains(os.path.join(self.dir, "link", os.path.relpath(entry, cache.path), "a", "x")))
+        self.assertFalse(cache.contains(cache.path + "-other"))
+        self.assertFalse(cache.contains(os.path.join(self.dir, "x")))
+        cache.release()
+
+    def test_dedupe_and_evict(self):
+        cache = tcgaImport.ExtractCache(os.path.join(self.dir, "cache"), max_size=250, dedupe=True)
+        shared = "s" * 100
+        a = cache.acquire("%032x" % (1), writeTree([("a/shared", shared), ("a/x", "x" * 50)]))
+        b = cache.acquire("%032x" % (2), writeTree([("b/shared", shared), ("b/y", "y" * 50)]))
+        self.assertTrue(os.path.samefile(os.path.join(a, "a", "shared"), os.path.join(b, "b", "shared")))
+        cache.release()
+        #another job goes over max_size with a third entry, the least recently used one goes
+        cache = tcgaImport.ExtractCache(cache.path, max_size=250, dedupe=True)
+        cache.acquire("%032x" % (3), writeTree([("c/z", "z" * 100)]))
+        cache.release()
+        self.assertFalse(os.path.exists(a))
+        self.assertEqual(open(os.path.join(b, "b", "shared")).read(), shared)
+        objects = [ os.path.join(d, f) for d, dirs, files in os.walk(os.path.join(cache.path, ".objects")) for f in files ]
+        #x went with the first entry, shared is still used by the second
+        self.assertEqual(sorted( open(o).read()[0] for o in objects ), ["s", "y", "z"])
+        self.assertFalse(os.path.exists(os.path.join(cache.path, "objects.lock")))
+
+    def test_evict_against_acquire(self):
+        path = os.path.join(self.dir, "cache")
+        cache = tcgaImport.ExtractCache(path)
+        victim = cache.acquire("%032x" % (1), writeTree([("a/x", "x" * 100)]))
+        cache.release()
+        os.utime(victim + ".size", (1, 1))
+        cache = tcgaImport.ExtractCache(path, max_size=150)
+        threads = []
+        rmtree = shutil.rmtree
+        def removing(tree, *args):
+            if tree == victim and len(threads) == 0:
+                #another thread of the job asks for the entry while it is being removed
+                threads.append(threading.Thread(target=cache.acquire, args=("%032x" % (1), writeTree([("a/x", "x" * 100)]))))
+                threads[0].start()
+                threads[0].join(0.5)
+                self.assertTrue(threads[0].is_alive())
+            rmtree(tree, *args)
+        tcgaImport.shutil.rmtree = removing
+        try:
+            cache.acquire("%032x" % (2), writeTree([("b/y", "y" * 100)]))
+            threads[0].join()
+        finally:
+            tcgaImport.shutil.rmtree = rmtree
+        #it waited for the eviction and extracted the archive again
+        self.assertEqual(open(os.path.join(victim, "a", "x")).read(), "x" * 100)
+        cache.release()
+
+if __name__ == "__main__":
+    unittest.main()
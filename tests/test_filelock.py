@@ -0,0 +1,67 @@
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tcgaImport
+
+
+class FileLockTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_removed_on_release(self):
+        path = os.path.join(self.dir, "a.tar.gz.lock")
+        with tcgaImport.FileLock(path):
+            self.assertTrue(os.path.exists(path))
+        self.assertFalse(os.path.exists(path))
+
+    def test_exclusive_between_processes(self):
+        path = os.path.join(self.dir, "a.tar.gz.lock")
+        count = os.path.join(self.dir, "count")
+        open(count, "w").write("0")
+        pids = []
+        for i in range(4):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    for j in range(50):
+                        with tcgaImport.FileLock(path):
+                            n = int(open(count).read())
+                            open(count, "w").write(str(n + 1))
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        self.assertEqual(open(count).read(), "200")
+        self.assertFalse(os.path.exists(path))
+
+    def test_threads(self):
+        counts = {}
+        def run(path):
+            for j in range(50):
+                with tcgaImport.FileLock(path):
+                    n = counts.get(path, 0)
+                    time.sleep(0.0001)
+                    counts[path] = n + 1
+        paths = [ os.path.join(self.dir, "%d.lock" % (i % 2)) for i in range(6) ]
+        threads = [ threading.Thread(target=run, args=(path,)) for path in paths ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(counts.values()), [150, 150])
+        #the thread locks of released paths are dropped
+        self.assertEqual(tcgaImport.FileLock.threadLocks, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from argparse import Namespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tcgaImport
+
+
+class ParseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.dir, "work")
+        self.cachePath = os.path.join(self.dir, "cache")
+        self.archive = os.path.join(self.root, "a.Level_3.1.0.0")
+        os.makedirs(self.archive)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def writeArchive(self, files):
+        for name in os.listdir(self.archive):
+            os.unlink(os.path.join(self.archive, name))
+        handle = open(os.path.join(self.archive, "MANIFEST.txt"), "w")
+        for name, md5 in files:
+            handle.write("%s  %s\n" % (md5, name))
+            open(os.path.join(self.archive, name), "w").write(name)
+        handle.close()
+        return [ os.path.join(self.archive, name) for name, md5 in files ]
+
+    def build(self, paths):
+        """Returns which paths were parsed rather than loaded"""
+        cache = tcgaImport.ParseCache(self.cachePath, [self.root])
+        parsed = []
+        for path in paths:
+            if cache.has(path):
+                self.assertEqual(cache.load(path), { 'result' : os.path.basename(path) })
+            else:
+                parsed.append(os.path.basename(path))
+                cache.save(path, { 'result' : os.path.basename(path) })
+        cache.finish()
+        return parsed
+
+    def test_incremental(self):
+        paths = self.writeArchive([ ("s1.txt", "1" * 32), ("s2.txt", "2" * 32) ])
+        self.assertEqual(self.build(paths), ["s1.txt", "s2.txt"])
+        self.assertEqual(self.build(paths), [])
+        #a new revision changes s2, adds s3 and drops s1
+        paths = self.writeArchive([ ("s2.txt", "4" * 32), ("s3.txt", "3" * 32) ])
+        self.assertEqual(self.build(paths), ["s2.txt", "s3.txt"])
+        self.assertEqual(len([ n for n in os.listdir(self.cachePath) if n.endswith(".pkl") ]), 2)
+
+    def test_version(self):
+        paths = self.writeArchive([ ("s1.txt", "1" * 32) ])
+        self.build(paths)
+        version = tcgaImport.PARSE_CACHE_VERSION
+        tcgaImport.PARSE_CACHE_VERSION = version + 1
+        try:
+            self.assertEqual(self.build(paths), ["s1.txt"])
+        finally:
+            tcgaImport.PARSE_CACHE_VERSION = version
+
+    def test_stream_rejected(self):
+        self.assertEqual(tcgaImport.main_build(Namespace(incremental=self.cachePath, stream=True)), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+import os
+import sys
+import unittest
+import StringIO
+
+import pandas as pd
+from pandas.util.testing import assert_frame_equal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tcgaImport
+
+
+class ReadProbeColumnsTest(unittest.TestCase):
+    names = ["isoform_id", "raw_count", "scaled_estimate", "transcript_id"]
+
+    def check(self, text):
+        importer = tcgaImport.Illumina_RNASeqV2(None, {})
+        tmp = importer.readProbeColumns(StringIO.StringIO(text), self.names, 'isoformExp', indexName="isoform_id")
+        full = pd.read_csv(StringIO.StringIO(text), sep="\t", header=None, names=self.names, index_col=0)
+        full = full[["raw_count"]]
+        assert_frame_equal(tmp, full)
+        out = StringIO.StringIO()
+        tmp.to_csv(out, sep="\t", float_format="%0.6g")
+        expected = StringIO.StringIO()
+        full.to_csv(expected, sep="\t", float_format="%0.6g")
+        self.assertEqual(out.getvalue(), expected.getvalue())
+        return tmp
+
+    def test_int_column(self):
+        tmp = self.check("uc001.1\t1234567\t0.5\tx\nuc002.1\t89\tNA\ty\n")
+        self.assertEqual(tmp["raw_count"].dtype.kind, "i")
+
+    def test_non_numeric_cell(self):
+        tmp = self.check("uc001.1\tnull\t0.5\tx\nuc002.1\t17.5\tNA\ty\n")
+        self.assertEqual(list(tmp["raw_count"]), ["null", "17.5"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tcgaImport
+
+
+class QueryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_put_get(self):
+        cache = tcgaImport.QueryCache(self.dir)
+        cache.put("http://a", "<page/>")
+        self.assertEqual(cache.get("http://a"), "<page/>")
+        self.assertEqual(cache.get("http://b"), None)
+
+    def test_replace_counts_once(self):
+        cache = tcgaImport.QueryCache(self.dir, max_size=1000)
+        cache.put("http://a", "a" * 100)
+        for i in range(5):
+            cache.put("http://b", "b" * 40)
+        cache.put("http://b", "b" * 10)
+        self.assertEqual(cache.size, 110)
+
+    def test_evicts_least_recently_used(self):
+        cache = tcgaImport.QueryCache(self.dir, max_size=150)
+        cache.put("http://a", "a" * 100)
+        os.utime(cache.entryPath("http://a"), (1, 1))
+        cache.put("http://b", "b" * 100)
+        self.assertEqual(cache.get("http://a"), None)
+        self.assertEqual(cache.get("http://b"), "b" * 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import sys
+import gzip
+import time
+import random
+import shutil
+import tarfile
+import tempfile
+import unittest
+import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tcgaImport
+
+
+class TarIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        random.seed(1)
+        self.files = [ ("a/%d.txt" % (i), os.urandom(random.randint(0, 300000))) for i in range(8) ]
+        self.files.append( ("a/sdrf.txt", "Extract Name\tfile\n") )
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def writeTar(self, path, files):
+        tar = tarfile.open(path, mode="w:gz")
+        for name, data in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, StringIO.StringIO(data))
+        tar.close()
+
+    def test_read_members(self):
+        path = os.path.join(self.dir, "a.tar.gz")
+        self.writeTar(path, self.files)
+        index = tcgaImport.TarIndex.load(path)
+        self.assertEqual([ m[0] for m in index.members ], [ f[0] for f in self.files ])
+        self.assertTrue(os.path.exists(path + ".idx"))
+        #small checkpoints, so seeks back restart part way through the file
+        checkpoints = []
+        reader = tcgaImport.GzipReader(path, checkpoints, chunk_size=4096, checkpoint_size=65536)
+        for name, data in self.files + list(reversed(self.files)):
+            self.assertEqual(index.read(name, reader), data)
+        reader.close()
+        self.assertTrue(len(checkpoints) > 1)
+        self.assertRaises(KeyError, index.read, "a/missing.txt", reader)
+
+    def test_stale_index(self):
+        path = os.path.join(self.dir, "a.tar.gz")
+        self.writeTar(path, self.files)
+        tcgaImport.TarIndex.load(path)
+        time.sleep(0.01)
+        self.writeTar(path, self.files[:2])
+        index = tcgaImport.TarIndex.load(path)
+        self.assertEqual([ m[0] for m in index.members ], [ f[0] for f in self.files[:2] ])
+
+    def test_concatenated_members(self):
+        #bgzip style, the tar stream split over several gzip members
+        tarPath = os.path.join(self.dir, "a.tar")
+        tar = tarfile.open(tarPath, mode="w")
+        for name, data in self.files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, StringIO.StringIO(data))
+        tar.close()
+        data = open(tarPath, "rb").read()
+        path = os.path.join(self.dir, "a.tar.gz")
+        handle = open(path, "wb")
+        for i in range(0, len(data), 100000):
+            out = StringIO.StringIO()
+            gz = gzip.GzipFile(fileobj=out, mode="wb")
+            gz.write(data[i:i + 100000])
+            gz.close()
+            handle.write(out.getvalue())
+        handle.close()
+        index = tcgaImport.TarIndex.load(path)
+        reader = tcgaImport.GzipReader(path)
+        for name, data in reversed(self.files):
+            self.assertEqual(index.read(name, reader), data)
+        reader.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
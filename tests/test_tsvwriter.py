@@ -0,0 +1,68 @@
+import os
+import sys
+import random
+import unittest
+import StringIO
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tcgaImport
+
+
+def randomFrame(rng):
+    nrows = rng.randint(0, 40)
+    columns = {}
+    names = []
+    for j in range(rng.randint(1, 4)):
+        kind = rng.choice(["float", "float", "int", "object"])
+        if kind == "float":
+            values = np.array([ rng.choice([np.nan, rng.uniform(-1e7, 1e7), rng.random(), 0.0]) for i in range(nrows) ])
+        elif kind == "int":
+            values = np.array([ rng.randint(-10**9, 10**9) for i in range(nrows) ], dtype=np.int64)
+        else:
+            values = np.array([ rng.choice([None, "a", "b c", 'q"uote', "t\tab", ""]) for i in range(nrows) ], dtype=object)
+        name = "col%d" % (j)
+        names.append(name)
+        columns[name] = values
+    index = rng.choice([
+        [ "TCGA-%02d" % (i) for i in range(nrows) ],
+        [ rng.choice(["p1", "p 2", "p\t3", 'p"4']) for i in range(nrows) ],
+        range(nrows)
+    ])
+    df = pd.DataFrame(columns, columns=names, index=index)
+    df.index.name = rng.choice([None, "probe"])
+    return df
+
+
+class TSVWriterTest(unittest.TestCase):
+    def compare(self, df, index, jobs=1):
+        expected = StringIO.StringIO()
+        df.to_csv(expected, sep="\t", index=index, float_format="%0.6g")
+        writer = tcgaImport.TSVWriter.fromFrame(df, index=index, float_format="%0.6g", block_size=7)
+        self.assertTrue(writer is not None)
+        out = StringIO.StringIO()
+        writer.write(out, jobs=jobs)
+        self.assertEqual(out.getvalue(), expected.getvalue())
+
+    def test_single_column_nan(self):
+        df = pd.DataFrame({ "a" : [1.5, np.nan, np.nan, 2.0] })
+        self.compare(df, False)
+        self.compare(df, True)
+
+    def test_random_frames(self):
+        rng = random.Random(20)
+        for i in range(300):
+            df = randomFrame(rng)
+            for index in [True, False]:
+                self.compare(df, index)
+
+    def test_random_frames_jobs(self):
+        rng = random.Random(21)
+        for i in range(5):
+            self.compare(randomFrame(rng), rng.choice([True, False]), jobs=2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,6 +4,7 @@ import synapseHelpers
 import pandas as pd
 import hashlib
 from synapseHelpers import query2df, thisCodeInSynapse
+import tcgaImport
 #from multiprocessing.dummy  import Pool
 
 QUERY_STR = "select * from file where benefactorId=='syn2812961' and acronym=='PANCAN'"
@@ -52,7 +53,7 @@ inputFiles = synapseHelpers.query2df(syn.chunkedQuery(QUERY_STR))
 code=synapseHelpers.thisCodeInSynapse(parentId='syn1774100')
 for i, row in inputFiles.iterrows():
     print row.id, row['name'],
-    inputFileEntity = syn.get(row.id)
+    inputFileEntity = syn.get(row.id, downloadFile=False)
     outFileName = row['name'][:-4]+'_whitelisted'+row['name'][-4:]
     
     toRemove = set(whitelist.ix[whitelist.Do_not_use & (whitelist.platform == row['platform']), 
@@ -64,7 +65,7 @@ for i, row in inputFiles.iterrows():
         syn.store(e, used=[inputFileEntity, whitelistEntity], executed=code)
         continue
     if row.fileType =='bed5':  #Do the filtering for bed files
-        df = pd.read_csv(inputFileEntity.path, sep='\t')
+        df = tcgaImport.readSynapseProduct(syn, inputFileEntity, fileType='seg')
         print df.shape,
         idx = ~df.Sample.isin(toRemove)
         df = df[idx]
@@ -73,12 +74,11 @@ for i, row in inputFiles.iterrows():
         nFeatures = 0
         nSamples = len(set(df.Sample))
     else: #All other fileTypes
-        df = pd.read_csv(inputFileEntity.path, sep='\t', index_col=0)
-        print df.shape,
-        colsToKeep = [col for col in df.columns if (col.startswith('TCGA') and 
-                                                    (col.split('.')[0] not in toRemove) and
-                                                    ('.' not in col))]
-        df = df.ix[:, colsToKeep]
+        keep = lambda col: (col.startswith('TCGA') and 
+                            (col.split('.')[0] not in toRemove) and
+                            ('.' not in col))
+        #only the columns kept are read
+        df = tcgaImport.readSynapseProduct(syn, inputFileEntity, columns=keep)
         print '->', df.shape
         df.to_csv('/gluster/home/lomberg/tcgaImport/out/'+outFileName, sep='\t')
         nFeatures , nSamples = df.shape